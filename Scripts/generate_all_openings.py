@@ -10,6 +10,9 @@ Usage:
     python3 generate_all_openings.py --dry-run          # Validate moves only
     python3 generate_all_openings.py --skip-api          # Use placeholder content
     python3 generate_all_openings.py --only vienna,slav  # Generate specific openings
+    python3 generate_all_openings.py --pretty            # Indented JSON for debugging
+    python3 generate_all_openings.py --workers 8         # Generate 8 openings at a time
+    python3 generate_all_openings.py --batch             # Use the Message Batches API
 
 Environment:
     ANTHROPIC_API_KEY - Required for Claude API calls (unless --skip-api)
@@ -19,8 +22,14 @@ import argparse
 import json
 import os
 import sys
+import threading
 import time
 import re
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from functools import lru_cache, partial
+from itertools import islice
 from pathlib import Path
 
 try:
@@ -34,6 +43,8 @@ try:
 except ImportError:
     anthropic = None
 
+from script_utils import decode_json, parse_uci, write_json
+
 # ---------------------------------------------------------------------------
 # Output directory (relative to this script)
 # ---------------------------------------------------------------------------
@@ -47,22 +58,231 @@ EXISTING_IDS = {"italian", "london"}
 # Claude model to use
 MODEL = "claude-sonnet-4-20250514"
 
-# Rate limiting: seconds between API calls
+# Rate limiting: minimum seconds between API call starts
 API_DELAY = 1.5
 
+# Maximum number of Claude calls in flight at once
+API_CONCURRENCY = 4
+
+# Output token limit for each content stage's Claude call
+MAX_TOKENS = {"explanations": 3000, "plan": 2000, "lessons": 4000, "responses": 2000}
+
+# Seconds between status checks while a --batch job is processing
+BATCH_POLL_INTERVAL = 30
+
+# Version of the generated JSON layout. Bump it when the output changes so
+# files written by an older version are regenerated instead of skipped.
+SCHEMA_VERSION = 1
+
+# Shared system prompt for every Claude call. It holds the coach persona and
+# all fixed JSON schemas so the prefix is byte-identical across calls and
+# openings; call_claude() marks it for prompt caching (needs >= 1024 tokens).
+SYSTEM_PROMPT = """You are an expert chess coach writing content for ChessCoach, an app that teaches chess openings to beginners (ELO ~800-1200).
+
+General rules:
+- Use beginner-friendly language throughout; avoid jargon.
+- Explain WHY moves are played (strategy and ideas), not just what they do.
+- Squares are always algebraic notation (e.g., "e4", "d5").
+- Be specific to the opening named in the request.
+- Return ONLY valid JSON in exactly the format given for the task, with no extra keys and no text outside the JSON.
+
+Each request names one of the tasks below and supplies the opening-specific data.
+
+## Task: MOVE EXPLANATIONS
+
+For each listed move, write a 1-2 sentence explanation suitable for a chess beginner learning this opening.
+- Explain WHY the move is played (strategy, not just what it does)
+- Use simple language, avoid jargon
+- For the player's moves (the color the opening is played as): explain the idea/plan behind the move
+- For the opponent's moves: explain what the opponent is trying to achieve
+
+Return ONLY a JSON array of strings, one explanation per move, in the same order:
+["explanation for move 1", "explanation for move 2", ...]
+
+## Task: PLAN
+
+Generate a comprehensive opening plan. Return ONLY valid JSON matching this EXACT schema (no extra keys):
+{
+  "summary": "2-3 sentence summary of what you're trying to achieve in this opening",
+  "strategicGoals": [
+    {"description": "specific goal 1", "priority": 1},
+    {"description": "specific goal 2", "priority": 2},
+    {"description": "specific goal 3", "priority": 3},
+    {"description": "specific goal 4", "priority": 4}
+  ],
+  "pawnStructureTarget": "description of ideal pawn structure",
+  "keySquares": ["e4", "d5", "f5"],
+  "pieceTargets": [
+    {"piece": "light-squared bishop", "idealSquares": ["c4", "b3"], "reasoning": "why this piece goes here"},
+    {"piece": "knight", "idealSquares": ["f3"], "reasoning": "why"}
+  ],
+  "typicalPlans": ["plan 1 in 1 sentence", "plan 2", "plan 3"],
+  "commonMistakes": ["mistake 1", "mistake 2", "mistake 3"],
+  "historicalNote": "1-2 sentences of historical context about this opening"
+}
+
+Key squares should be algebraic notation (e.g., "e4", "d5").
+Include 3-5 piece targets with specific ideal squares.
+
+## Task: LESSONS
+
+Generate lessons and quizzes. Return ONLY valid JSON with this EXACT structure:
+{
+  "planLessons": [
+    {
+      "title": "Short title (3-6 words)",
+      "description": "2-3 sentence explanation of this concept for beginners",
+      "fen": "USE AN EXACT FEN FROM THE POSITIONS GIVEN",
+      "highlights": ["e4", "d5"],
+      "arrows": [{"from": "e2", "to": "e4"}],
+      "style": "good"
+    }
+  ],
+  "planQuizzes": [
+    {
+      "fen": "USE AN EXACT FEN FROM THE POSITIONS GIVEN",
+      "prompt": "Question about the position (1 sentence)",
+      "choices": [
+        {"text": "Correct answer with brief reason", "isCorrect": true},
+        {"text": "Wrong answer 1", "isCorrect": false},
+        {"text": "Wrong answer 2", "isCorrect": false}
+      ],
+      "correctIndex": 0,
+      "explanation": "1-2 sentence explanation of why the correct answer is right",
+      "boardHighlightsOnReveal": ["e4"],
+      "arrowsOnReveal": [{"from": "e2", "to": "e4"}]
+    }
+  ],
+  "theoryLessons": [
+    {
+      "title": "Variation Name (ECO code if known)",
+      "description": "2-3 sentence explanation of this variation",
+      "fen": "USE AN EXACT FEN",
+      "highlights": ["c5", "d4"],
+      "arrows": [{"from": "c7", "to": "c5"}],
+      "style": "theory"
+    }
+  ],
+  "theoryQuizzes": [
+    {
+      "fen": "USE AN EXACT FEN",
+      "prompt": "Question about variations/theory",
+      "choices": [
+        {"text": "Correct answer", "isCorrect": true},
+        {"text": "Wrong answer 1", "isCorrect": false},
+        {"text": "Wrong answer 2", "isCorrect": false}
+      ],
+      "correctIndex": 0,
+      "explanation": "Why this is correct",
+      "boardHighlightsOnReveal": ["d4"],
+      "arrowsOnReveal": []
+    }
+  ]
+}
+
+Requirements:
+- 3-5 planLessons (concepts: center control, piece development, king safety, pawn structure, common mistakes)
+- 2-3 planQuizzes
+- 2-4 theoryLessons (one per major variation)
+- 2 theoryQuizzes
+- ALL FEN strings MUST be exact copies from the positions listed in the request
+- highlights and arrows use algebraic squares (e.g., "e4", "d5")
+- style is one of: "good", "bad", "theory"
+- Use beginner-friendly language throughout
+
+## Task: OPPONENT RESPONSES
+
+Identify the 3-4 most important/common opponent responses and return ONLY valid JSON:
+[
+  {
+    "uci": "exact uci from the list",
+    "san": "exact san from the list",
+    "name": "Standard opening variation name",
+    "eco": "ECO code (e.g., C54)",
+    "frequency": 0.40,
+    "description": "1 sentence beginner-friendly description",
+    "explanation": "1 sentence explaining why the opponent plays this",
+    "planAdjustment": "1 sentence on how to adjust your plan"
+  }
+]
+
+Requirements:
+- Frequencies should sum to roughly 1.0
+- Use EXACT uci and san strings from the legal moves list in the request
+- Use standard opening names where applicable
+- Be specific about plan adjustments"""
+
+# Per-task user prompt templates, rendered with str.format(). Only the
+# opening-specific data lives here; the fixed instructions are in SYSTEM_PROMPT.
+EXPLANATIONS_PROMPT = """Task: MOVE EXPLANATIONS
+
+Opening: {name} (played as {color})
+
+Moves:
+{moves}"""
+
+PLAN_PROMPT = """Task: PLAN
+
+Opening: {name}
+The player plays as {color}.
+Main line: {main_line}"""
+
+LESSONS_PROMPT = """Task: LESSONS
+
+Opening: {name} (played as {color})
+
+Main line: {main_line}
+
+Key FEN positions (by ply number):
+{fen_positions}
+
+Variations:
+{variations}"""
+
+RESPONSES_PROMPT = """Task: OPPONENT RESPONSES
+
+In the {name} opening, after the moves: {moves}
+
+The position FEN is: {fen}
+
+Legal moves include: {legal_moves}"""
+
 # ---------------------------------------------------------------------------
 # Opening definitions
 # ---------------------------------------------------------------------------
+
 # Each opening has:
 #   id, name, description, color, difficulty,
-#   main_line: list of UCI move strings for the main line,
-#   variations: list of dicts with:
+#   main_line: UCI move strings for the main line,
+#   variations: Variation entries with:
 #       name: variation name
 #       branch_ply: ply number where the variation branches (0-indexed)
 #       moves: UCI moves FROM the branch point onward (replacing main line moves)
 #   response_after_ply: ply after which to catalogue opponent responses
-
-OPENINGS = [
+#
+# The definitions below are written as plain dicts for readability and
+# converted to frozen Opening/Variation instances in OPENINGS.
+
+@dataclass(frozen=True, slots=True)
+class Variation:
+    name: str
+    branch_ply: int
+    moves: tuple[str, ...]
+
+
+@dataclass(frozen=True, slots=True)
+class Opening:
+    id: str
+    name: str
+    description: str
+    color: str
+    difficulty: int
+    main_line: tuple[str, ...]
+    variations: tuple[Variation, ...] = ()
+    response_after_ply: int | None = None
+
+
+_OPENING_SPECS = [
     # =========================================================================
     # WHITE OPENINGS (10 new)
     # =========================================================================
@@ -900,17 +1120,41 @@ OPENINGS = [
 ]
 
 
+OPENINGS = tuple(
+    Opening(
+        id=spec["id"],
+        name=spec["name"],
+        description=spec["description"],
+        color=spec["color"],
+        difficulty=spec["difficulty"],
+        main_line=tuple(spec["main_line"]),
+        variations=tuple(
+            Variation(name=v["name"], branch_ply=v["branch_ply"], moves=tuple(v["moves"]))
+            for v in spec.get("variations", [])
+        ),
+        response_after_ply=spec.get("response_after_ply"),
+    )
+    for spec in _OPENING_SPECS
+)
+
+
 # ---------------------------------------------------------------------------
 # Move validation helpers
 # ---------------------------------------------------------------------------
 
-def validate_moves(moves: list[str]) -> list[tuple[str, str, str]]:
-    """Validate a sequence of UCI moves. Returns [(uci, san, fen_after), ...]."""
-    board = chess.Board()
+def validate_moves(moves: list[str], board: chess.Board | None = None) -> list[tuple[str, str, str]]:
+    """Validate a sequence of UCI moves. Returns [(uci, san, fen_after), ...].
+
+    Moves are played from `board` (pushed onto it) when given, otherwise from
+    the starting position. Legality is checked per move with Board.is_legal()
+    rather than by enumerating every legal move.
+    """
+    if board is None:
+        board = chess.Board()
     result = []
     for uci_str in moves:
-        move = chess.Move.from_uci(uci_str)
-        if move not in board.legal_moves:
+        move = parse_uci(uci_str)
+        if not board.is_legal(move):
             raise ValueError(f"Illegal move {uci_str} in position:\n{board.fen()}\n{board}")
         san = board.san(move)
         board.push(move)
@@ -918,11 +1162,98 @@ def validate_moves(moves: list[str]) -> list[tuple[str, str, str]]:
     return result
 
 
+@dataclass(frozen=True, slots=True)
+class MainLine:
+    """A validated main line, replayed once per opening and shared by all stages.
+
+    moves[i] is (uci, san, fen_after) for ply i + 1; boards[i] is the position
+    after the first i plies (boards[0] is the starting position), copied
+    without its move stack. The boards are shared across threads (the content
+    stages run concurrently) and through validate_main_line's cache, so they
+    must never be mutated: copy(stack=False) before calling san(), push() or
+    anything else that touches the move stack. notation is the whole line as numbered SAN.
+    """
+    moves: list[tuple[str, str, str]]
+    boards: list[chess.Board]
+    notation: str
+
+
+def numbered_notation(sans) -> str:
+    """Format SAN moves as numbered move text, e.g. "1. e4 e5 2. Nf3"."""
+    parts = []
+    for i, san in enumerate(sans):
+        parts.append(f"{i // 2 + 1}. {san}" if i % 2 == 0 else san)
+    return " ".join(parts)
+
+
+@lru_cache(maxsize=None)
+def validate_main_line(main_line: tuple[str, ...]) -> MainLine:
+    """Validate the main line once, keeping a board snapshot after every ply.
+
+    Cached by move tuple, so --batch prompt collection and the generation
+    pass share one MainLine per opening; callers must not mutate it.
+    """
+    board = chess.Board()
+    boards = [board.copy(stack=False)]
+    moves = []
+    for uci_str in main_line:
+        moves.extend(validate_moves([uci_str], board))
+        boards.append(board.copy(stack=False))
+    notation = numbered_notation(san for _, san, _ in moves)
+    return MainLine(moves=moves, boards=boards, notation=notation)
+
+
+def validate_opening(opening: Opening, fail_fast: bool = False) -> tuple[list[str], int]:
+    """Validate an opening's main line and variations. Returns (report_lines, error_count).
+
+    With fail_fast, stops at the first failing line instead of checking the rest.
+    """
+    lines = [f"  {opening.name} ({opening.id})..."]
+    errors = 0
+    # Replay the main line once, keeping the position after every ply, so
+    # each variation resumes from its branch point instead of re-validating
+    # the partial main line from move 1.
+    board = chess.Board()
+    boards = [board.copy(stack=False)]
+    main_error = None
+    for uci_str in opening.main_line:
+        try:
+            validate_moves([uci_str], board)
+        except ValueError as e:
+            main_error = e
+            break
+        boards.append(board.copy(stack=False))
+
+    if main_error is None:
+        lines.append(f"    Main line: OK ({len(opening.main_line)} moves)")
+    else:
+        lines.append(f"    Main line: FAILED - {main_error}")
+        errors += 1
+        if fail_fast:
+            return lines, errors
+
+    for var in opening.variations:
+        try:
+            # The main line up to the branch point must itself be legal
+            if main_error is not None and var.branch_ply >= len(boards):
+                raise main_error
+            board = boards[min(var.branch_ply, len(boards) - 1)].copy(stack=False)
+            validate_moves(var.moves, board)
+            lines.append(f"    {var.name}: OK ({len(var.moves)} moves from ply {var.branch_ply})")
+        except ValueError as e:
+            lines.append(f"    {var.name}: FAILED - {e}")
+            errors += 1
+            if fail_fast:
+                break
+
+    return lines, errors
+
+
 def get_fen_after(moves: list[str]) -> str:
     """Return FEN after playing a sequence of UCI moves."""
     board = chess.Board()
     for uci_str in moves:
-        board.push(chess.Move.from_uci(uci_str))
+        board.push(parse_uci(uci_str))
     return board.fen()
 
 
@@ -930,7 +1261,7 @@ def get_san(moves: list[str], move_index: int) -> str:
     """Get SAN for the move at move_index in the given sequence."""
     board = chess.Board()
     for i, uci_str in enumerate(moves):
-        m = chess.Move.from_uci(uci_str)
+        m = parse_uci(uci_str)
         if i == move_index:
             return board.san(m)
         board.push(m)
@@ -941,13 +1272,21 @@ def get_san(moves: list[str], move_index: int) -> str:
 # Tree building
 # ---------------------------------------------------------------------------
 
-def build_tree(opening: dict) -> dict:
-    """Build the opening tree JSON structure from hardcoded main line + variations."""
-    opening_id = opening["id"]
-    main_line = opening["main_line"]
+def _default_explanation(ply: int, san: str) -> str:
+    """Generic explanation for the move at 0-based ply, used until Claude provides one."""
+    side = "White" if ply % 2 == 0 else "Black"
+    return f"{side} plays {san}, continuing development."
+
 
-    # Validate main line
-    validated_main = validate_moves(main_line)
+def build_tree(opening: Opening, main: MainLine) -> dict:
+    """Build the opening tree JSON structure from hardcoded main line + variations.
+
+    Every move starts with a generic explanation, which
+    generate_move_explanations() overwrites with Claude's when it succeeds.
+    """
+    opening_id = opening.id
+    main_line = opening.main_line
+    validated_main = main.moves
 
     # Build main line nodes (nested)
     root = {
@@ -957,8 +1296,9 @@ def build_tree(opening: dict) -> dict:
         "weight": 0,
     }
 
-    # Create nested main line
+    # Create nested main line; main_line_nodes[i] is the node after i plies
     current_node = root
+    main_line_nodes = [root]
     path_so_far = []
     for i, (uci, san, fen) in enumerate(validated_main):
         path_so_far.append(uci)
@@ -966,52 +1306,46 @@ def build_tree(opening: dict) -> dict:
         weight = max(300 - i * 20, 50)
         child = {
             "id": node_id,
-            "move": {"uci": uci, "san": san, "explanation": ""},
+            "move": {"uci": uci, "san": san, "explanation": _default_explanation(i, san)},
             "isMainLine": True,
             "weight": weight,
             "children": [],
         }
         current_node["children"].append(child)
         current_node = child
+        main_line_nodes.append(child)
 
     # Graft variations
-    for var in opening.get("variations", []):
-        branch_ply = var["branch_ply"]
-        var_moves = var["moves"]
-        var_name = var["name"]
-
-        # Navigate to the branch point in the main line tree
-        parent = root
-        for i in range(branch_ply):
-            # Find the main line child
-            main_children = [c for c in parent["children"] if c.get("isMainLine")]
-            if not main_children:
-                break
-            parent = main_children[0]
-
-        # Validate variation moves from the board state at branch_ply
-        board = chess.Board()
-        for uci_str in main_line[:branch_ply]:
-            board.push(chess.Move.from_uci(uci_str))
+    board = None
+    board_ply = None
+    for var in opening.variations:
+        branch_ply = var.branch_ply
+        var_moves = var.moves
+        var_name = var.name
+
+        # The branch point in the main line tree (its last node if the
+        # variation branches past the end of the main line)
+        parent = main_line_nodes[min(branch_ply, len(main_line_nodes) - 1)]
+
+        # Validate variation moves from the cached board at branch_ply,
+        # clamped like parent. Variations sharing a branch point reuse one
+        # copy, popping the previous variation's moves (the copy starts with
+        # an empty stack).
+        board_index = min(branch_ply, len(main.boards) - 1)
+        if board_index != board_ply:
+            board = main.boards[board_index].copy(stack=False)
+            board_ply = board_index
+        else:
+            while board.move_stack:
+                board.pop()
 
         # Build variation path prefix from main line
         main_path = main_line[:branch_ply]
 
         try:
-            var_validated = []
-            var_board = board.copy()
-            for uci_str in var_moves:
-                m = chess.Move.from_uci(uci_str)
-                if m not in var_board.legal_moves:
-                    raise ValueError(
-                        f"Illegal variation move {uci_str} in {var_name} "
-                        f"at position:\n{var_board.fen()}"
-                    )
-                san = var_board.san(m)
-                var_board.push(m)
-                var_validated.append((uci_str, san, var_board.fen()))
+            var_validated = validate_moves(var_moves, board)
         except ValueError as e:
-            print(f"  WARNING: Skipping variation '{var_name}': {e}")
+            print(f"  [{opening_id}] WARNING: Skipping variation '{var_name}': {e}")
             continue
 
         # Build the variation branch
@@ -1023,7 +1357,7 @@ def build_tree(opening: dict) -> dict:
             weight = max(200 - (branch_ply + j) * 15, 30)
             child = {
                 "id": node_id,
-                "move": {"uci": uci, "san": san, "explanation": ""},
+                "move": {"uci": uci, "san": san, "explanation": _default_explanation(branch_ply + j, san)},
                 "isMainLine": False,
                 "weight": weight,
                 "children": [],
@@ -1040,197 +1374,286 @@ def build_tree(opening: dict) -> dict:
 # Claude API helpers
 # ---------------------------------------------------------------------------
 
+# Start of a JSON object or array in a response
+_JSON_START_RE = re.compile(r"[{\[]")
+
+
 def extract_json_from_response(text: str):
-    """Extract JSON from a Claude response, handling markdown code blocks."""
+    """Extract JSON from a Claude response, handling markdown code blocks.
+
+    The payload runs from the first "{" or "[" to the last matching closer
+    (before the closing fence, if fenced), so surrounding fence lines and
+    prose are skipped without splitting the response into lines.
+    """
     text = text.strip()
-    # Remove markdown code fences
     if text.startswith("```"):
-        lines = text.split("\n")
-        # Remove first and last fence lines
-        start = 1
-        end = len(lines)
-        for i in range(len(lines) - 1, 0, -1):
-            if lines[i].strip().startswith("```"):
-                end = i
-                break
-        text = "\n".join(lines[start:end]).strip()
-
-    if text.startswith("{") or text.startswith("["):
-        return json.loads(text)
+        fence_end = text.rfind("\n```")
+        if fence_end > 0:
+            text = text[:fence_end]
 
-    # Try to find JSON object or array
-    for start_char, end_char in [("{", "}"), ("[", "]")]:
-        start = text.find(start_char)
-        end = text.rfind(end_char)
-        if start >= 0 and end > start:
-            try:
-                return json.loads(text[start:end + 1])
-            except json.JSONDecodeError:
-                continue
+    match = _JSON_START_RE.search(text)
+    if match:
+        start = match.start()
+        end = text.rfind("}" if text[start] == "{" else "]")
+        if end > start:
+            return decode_json(text[start:end + 1])
 
     raise ValueError(f"Could not extract JSON from response: {text[:200]}")
 
 
+class JSONStreamScanner:
+    """Incrementally track bracket nesting of a streamed JSON response.
+
+    Scanning starts at the first "{" or "[" that begins a line (after optional
+    indentation) or follows a markdown fence such as "```json", so brackets in
+    leading prose ("Here is the plan [JSON]: ...") are ignored. feed() returns
+    "complete" once that top-level value closes (`start` and `end` then delimit
+    it), "broken" on a mismatched closing bracket, and None otherwise.
+    """
+
+    _OPENERS = {"}": "{", "]": "["}
+
+    def __init__(self):
+        self.stack = []
+        self.in_string = False
+        self.escaped = False
+        self.offset = 0
+        self.start = None
+        self.end = None
+        # Text of the current line before the value starts
+        self.line = ""
+
+    def _starts_value(self) -> bool:
+        line = self.line.strip()
+        return not line or (line.startswith("```") and " " not in line)
+
+    def feed(self, chunk: str):
+        base = self.offset
+        self.offset += len(chunk)
+        for i, ch in enumerate(chunk):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif not self.stack:
+                if ch in "{[" and self._starts_value():
+                    self.stack.append(ch)
+                    self.start = base + i
+                elif ch == "\n":
+                    self.line = ""
+                else:
+                    self.line += ch
+            elif ch in "{[":
+                self.stack.append(ch)
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "}]":
+                if self.stack.pop() != self._OPENERS[ch]:
+                    return "broken"
+                if not self.stack:
+                    self.end = base + i + 1
+                    return "complete"
+        return None
+
+
+class RateLimiter:
+    """Thread-safe limiter that spaces call starts at least `interval` seconds apart.
+
+    Each caller reserves the next free start time under the lock and then
+    sleeps outside it, so waiting threads never block each other's bookkeeping.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class CacheStats:
+    """Thread-safe tally of input tokens served from, written to and missing the prompt cache."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.read = 0
+        self.written = 0
+        self.uncached = 0
+
+    def add(self, usage):
+        with self._lock:
+            self.calls += 1
+            self.read += usage.cache_read_input_tokens or 0
+            self.written += usage.cache_creation_input_tokens or 0
+            self.uncached += usage.input_tokens
+
+    def summary(self) -> str:
+        return (f"Prompt cache: {self.read} input tokens read, {self.written} written, "
+                f"{self.uncached} uncached over {self.calls} calls")
+
+
+_api_rate_limiter = RateLimiter(API_DELAY)
+_api_slots = threading.Semaphore(API_CONCURRENCY)
+_cache_stats = CacheStats()
+
+
+def message_params(prompt: str, max_tokens: int) -> dict:
+    """Request parameters for one Claude call, with the system prompt marked for caching."""
+    return {
+        "model": MODEL,
+        "max_tokens": max_tokens,
+        "system": [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}],
+        "messages": [{"role": "user", "content": prompt}],
+    }
+
+
+class BatchResults:
+    """Stand-in client holding the responses of a finished Message Batch.
+
+    call_claude() answers from here instead of the API; a prompt whose batch
+    request failed raises ValueError so the stage falls back to placeholders.
+    """
+
+    def __init__(self, texts: dict[str, str], errors: dict[str, str]):
+        self.texts = texts
+        self.errors = errors
+
+    def text_for(self, prompt: str) -> str:
+        if prompt in self.texts:
+            return self.texts[prompt]
+        raise ValueError(self.errors.get(prompt, "No batch result for prompt"))
+
+
 def call_claude(client, prompt: str, max_tokens: int = 4000) -> str:
-    """Call Claude API with rate limiting."""
-    response = client.messages.create(
-        model=MODEL,
-        max_tokens=max_tokens,
-        messages=[{"role": "user", "content": prompt}],
-    )
-    time.sleep(API_DELAY)
-    return response.content[0].text
+    """Stream a Claude response with shared rate limiting and the cached system prompt.
+
+    Stops reading once the JSON payload is complete (skipping any trailing
+    prose) and raises ValueError as soon as its brackets stop matching.
+    """
+    if isinstance(client, BatchResults):
+        return client.text_for(prompt)
+
+    scanner = JSONStreamScanner()
+    parts = []
+    with _api_slots:
+        _api_rate_limiter.wait()
+        with client.messages.stream(**message_params(prompt, max_tokens)) as stream:
+            for text in stream.text_stream:
+                parts.append(text)
+                status = scanner.feed(text)
+                if status == "complete":
+                    break
+                if status == "broken":
+                    raise ValueError(f"Malformed JSON in streamed response: {''.join(parts)[-200:]}")
+            # Input usage (including cache hits) arrives with the first event
+            _cache_stats.add(stream.current_message_snapshot.usage)
+    # Keep just the JSON value: drop leading prose or a fence line and
+    # anything after it (e.g. half of a closing code fence)
+    return "".join(parts)[scanner.start:scanner.end]
 
 
 # ---------------------------------------------------------------------------
 # Content generation
 # ---------------------------------------------------------------------------
 
-def generate_move_explanations(client, opening: dict, tree: dict) -> dict:
-    """Use Claude to generate beginner-friendly explanations for each move in the tree."""
-    # Collect all moves that need explanations
-    moves_info = []
-
-    def collect_moves(node, board_state_moves=None):
-        if board_state_moves is None:
-            board_state_moves = []
-        for child in node.get("children", []):
-            move_data = child.get("move", {})
-            uci = move_data.get("uci", "")
-            san = move_data.get("san", "")
-            var_name = child.get("variationName", "")
-            is_main = child.get("isMainLine", False)
-            moves_info.append({
-                "uci": uci,
-                "san": san,
-                "path": board_state_moves + [uci],
-                "var_name": var_name,
-                "is_main": is_main,
-            })
-            collect_moves(child, board_state_moves + [uci])
+def _explanation_moves(tree: dict) -> list[dict]:
+    """Collect all moves that need explanations, in pre-order.
 
-    collect_moves(tree)
+    Uses an explicit stack (children pushed in reverse) rather than recursion.
+    """
+    moves_info = []
+    stack = [(child, []) for child in reversed(tree.get("children", []))]
+    while stack:
+        node, board_state_moves = stack.pop()
+        move_data = node.get("move", {})
+        uci = move_data.get("uci", "")
+        path = board_state_moves + [uci]
+        moves_info.append({
+            "uci": uci,
+            "san": move_data.get("san", ""),
+            "path": path,
+            "var_name": node.get("variationName", ""),
+            "is_main": node.get("isMainLine", False),
+            "node": node,
+        })
+        for child in reversed(node.get("children", [])):
+            stack.append((child, path))
+    return moves_info
 
-    if not moves_info or client is None:
-        return tree
 
-    # Build prompt with all moves
-    opening_color = opening["color"]
-    move_list_str = ""
+def _explanations_prompt(opening: Opening, moves_info: list[dict]) -> str:
+    """Build the move explanations prompt listing every move in the tree."""
+    move_lines = []
     for i, m in enumerate(moves_info):
         side = "White" if len(m["path"]) % 2 == 1 else "Black"
         var_str = f" (start of {m['var_name']})" if m["var_name"] else ""
         main_str = " [main line]" if m["is_main"] else " [variation]"
-        move_list_str += f"{i+1}. {m['san']} ({m['uci']}) by {side}{var_str}{main_str}\n"
-
-    prompt = f"""You are generating beginner-friendly move explanations for the {opening['name']} chess opening (played as {opening_color}).
+        move_lines.append(f"{i+1}. {m['san']} ({m['uci']}) by {side}{var_str}{main_str}\n")
+    move_list_str = "".join(move_lines)
+    return EXPLANATIONS_PROMPT.format(name=opening.name, color=opening.color, moves=move_list_str)
 
-For each move below, write a 1-2 sentence explanation suitable for a chess beginner learning this opening.
-- Explain WHY the move is played (strategy, not just what it does)
-- Use simple language, avoid jargon
-- For the player's moves ({opening_color}): explain the idea/plan behind the move
-- For the opponent's moves: explain what the opponent is trying to achieve
 
-Moves:
-{move_list_str}
+def generate_move_explanations(client, opening: Opening, tree: dict) -> dict:
+    """Use Claude to generate beginner-friendly explanations for each move in the tree."""
+    moves_info = _explanation_moves(tree)
+    if not moves_info or client is None:
+        return tree
 
-Return ONLY a JSON array of strings, one explanation per move, in the same order:
-["explanation for move 1", "explanation for move 2", ...]"""
+    prompt = _explanations_prompt(opening, moves_info)
 
     try:
-        text = call_claude(client, prompt, max_tokens=3000)
+        text = call_claude(client, prompt, max_tokens=MAX_TOKENS["explanations"])
         explanations = extract_json_from_response(text)
-
-        # Apply explanations to tree
-        idx = [0]
-
-        def apply_explanations(node):
-            for child in node.get("children", []):
-                if idx[0] < len(explanations):
-                    child["move"]["explanation"] = explanations[idx[0]]
-                    idx[0] += 1
-                apply_explanations(child)
-
-        apply_explanations(tree)
+        if not isinstance(explanations, list):
+            raise ValueError("expected a JSON array")
+
+        # Apply explanations to tree (same order the moves were listed in),
+        # keeping the generic text for any entry that is not a string
+        for m, explanation in zip(moves_info, explanations):
+            if isinstance(explanation, str):
+                m["node"]["move"]["explanation"] = explanation
     except Exception as e:
-        print(f"  WARNING: Move explanation generation failed: {e}")
-        # Apply fallback explanations
-        _apply_fallback_explanations(tree, opening)
+        # build_tree's generic explanations stay in place
+        print(f"  [{opening.id}] WARNING: Move explanation generation failed: {e}")
 
     return tree
 
 
-def _apply_fallback_explanations(tree: dict, opening: dict):
-    """Apply generic fallback explanations when API fails."""
-    def apply(node, depth=0):
-        for child in node.get("children", []):
-            move = child.get("move", {})
-            san = move.get("san", "")
-            if not move.get("explanation"):
-                side = "White" if depth % 2 == 0 else "Black"
-                move["explanation"] = f"{side} plays {san}, continuing development."
-            apply(child, depth + 1)
-    apply(tree)
+def _plan_prompt(opening: Opening, main: MainLine) -> str:
+    """Build the plan prompt for the main line."""
+    return PLAN_PROMPT.format(name=opening.name, color=opening.color, main_line=main.notation)
 
 
-def generate_plan(client, opening: dict) -> dict:
+def generate_plan(client, opening: Opening, main: MainLine) -> dict:
     """Use Claude to generate the opening plan."""
     if client is None:
         return _placeholder_plan(opening)
 
-    # Get the main line in a readable format
-    board = chess.Board()
-    move_str = ""
-    for i, uci in enumerate(opening["main_line"]):
-        m = chess.Move.from_uci(uci)
-        san = board.san(m)
-        if i % 2 == 0:
-            move_str += f"{i//2 + 1}. {san} "
-        else:
-            move_str += f"{san} "
-        board.push(m)
-
-    prompt = f"""Generate a comprehensive opening plan for the {opening['name']} chess opening.
-The player plays as {opening['color']}.
-Main line: {move_str.strip()}
-
-Return ONLY valid JSON matching this EXACT schema (no extra keys):
-{{
-  "summary": "2-3 sentence summary of what you're trying to achieve in this opening",
-  "strategicGoals": [
-    {{"description": "specific goal 1", "priority": 1}},
-    {{"description": "specific goal 2", "priority": 2}},
-    {{"description": "specific goal 3", "priority": 3}},
-    {{"description": "specific goal 4", "priority": 4}}
-  ],
-  "pawnStructureTarget": "description of ideal pawn structure",
-  "keySquares": ["e4", "d5", "f5"],
-  "pieceTargets": [
-    {{"piece": "light-squared bishop", "idealSquares": ["c4", "b3"], "reasoning": "why this piece goes here"}},
-    {{"piece": "knight", "idealSquares": ["f3"], "reasoning": "why"}}
-  ],
-  "typicalPlans": ["plan 1 in 1 sentence", "plan 2", "plan 3"],
-  "commonMistakes": ["mistake 1", "mistake 2", "mistake 3"],
-  "historicalNote": "1-2 sentences of historical context about this opening"
-}}
-
-Be specific to the {opening['name']}. Use beginner-friendly language.
-Key squares should be algebraic notation (e.g., "e4", "d5").
-Include 3-5 piece targets with specific ideal squares."""
+    prompt = _plan_prompt(opening, main)
 
     try:
-        text = call_claude(client, prompt, max_tokens=2000)
+        text = call_claude(client, prompt, max_tokens=MAX_TOKENS["plan"])
         plan = extract_json_from_response(text)
         return plan
     except Exception as e:
-        print(f"  WARNING: Plan generation failed: {e}")
+        print(f"  [{opening.id}] WARNING: Plan generation failed: {e}")
         return _placeholder_plan(opening)
 
 
-def _placeholder_plan(opening: dict) -> dict:
+def _placeholder_plan(opening: Opening) -> dict:
     """Generate a placeholder plan when API is unavailable."""
     return {
-        "summary": f"The {opening['name']} is a {opening['color']} opening focusing on piece development and center control.",
+        "summary": f"The {opening.name} is a {opening.color} opening focusing on piece development and center control.",
         "strategicGoals": [
             {"description": "Control the center", "priority": 1},
             {"description": "Develop pieces actively", "priority": 2},
@@ -1246,52 +1669,34 @@ def _placeholder_plan(opening: dict) -> dict:
             "Neglecting development",
             "Forgetting to castle",
         ],
-        "historicalNote": f"The {opening['name']} has been played by many strong players throughout chess history.",
+        "historicalNote": f"The {opening.name} has been played by many strong players throughout chess history.",
     }
 
 
-def generate_lessons_and_quizzes(client, opening: dict) -> dict:
-    """Generate planLessons, planQuizzes, theoryLessons, theoryQuizzes."""
-    if client is None:
-        return _placeholder_lessons(opening)
-
-    main_line = opening["main_line"]
-    variations = opening.get("variations", [])
+def _lessons_prompt(opening: Opening, main: MainLine) -> str:
+    """Build the lessons prompt from the main line FENs and variation summaries."""
+    main_line = opening.main_line
+    variations = opening.variations
 
-    # Build FEN positions at various points
-    fens = {}
-    board = chess.Board()
-    move_strs = []
-    for i, uci in enumerate(main_line):
-        m = chess.Move.from_uci(uci)
-        san = board.san(m)
-        board.push(m)
-        fen = board.fen()
-        ply = i + 1
-        fens[ply] = fen
-        if i % 2 == 0:
-            move_strs.append(f"{i//2 + 1}. {san}")
-        else:
-            move_strs[-1] += f" {san}"
+    # FEN positions by ply, from the cached main line
+    fens = {str(ply): fen for ply, (_, _, fen) in enumerate(main.moves, 1)}
 
-    game_notation = " ".join(move_strs)
+    game_notation = main.notation
 
     # Collect variation info
     var_info = []
     for var in variations:
-        branch = var["branch_ply"]
-        vboard = chess.Board()
-        for uci in main_line[:branch]:
-            vboard.push(chess.Move.from_uci(uci))
+        branch = var.branch_ply
+        vboard = main.boards[min(branch, len(main.boards) - 1)].copy(stack=False)
         var_moves_san = []
-        for uci in var["moves"]:
-            m = chess.Move.from_uci(uci)
+        for uci in var.moves:
+            m = parse_uci(uci)
             san = vboard.san(m)
             vboard.push(m)
             var_moves_san.append(san)
         var_fen = vboard.fen()
         var_info.append({
-            "name": var["name"],
+            "name": var.name,
             "branch_ply": branch,
             "moves_san": var_moves_san,
             "final_fen": var_fen,
@@ -1311,108 +1716,44 @@ def generate_lessons_and_quizzes(client, opening: dict) -> dict:
     if line_len >= 10:
         key_plies.append(min(10, line_len))
 
-    fen_positions = json.dumps({str(k): v for k, v in fens.items()})
+    fen_positions = json.dumps(fens)
 
-    prompt = f"""Generate lessons and quizzes for the {opening['name']} chess opening (played as {opening['color']}).
-
-Main line: {game_notation}
-
-Key FEN positions (by ply number):
-{fen_positions}
+    return LESSONS_PROMPT.format(
+        name=opening.name,
+        color=opening.color,
+        main_line=game_notation,
+        fen_positions=fen_positions,
+        variations=json.dumps(var_info, indent=2),
+    )
 
-Variations:
-{json.dumps(var_info, indent=2)}
 
-Return ONLY valid JSON with this EXACT structure:
-{{
-  "planLessons": [
-    {{
-      "title": "Short title (3-6 words)",
-      "description": "2-3 sentence explanation of this concept for beginners",
-      "fen": "USE AN EXACT FEN FROM THE POSITIONS ABOVE",
-      "highlights": ["e4", "d5"],
-      "arrows": [{{"from": "e2", "to": "e4"}}],
-      "style": "good"
-    }}
-  ],
-  "planQuizzes": [
-    {{
-      "fen": "USE AN EXACT FEN FROM THE POSITIONS ABOVE",
-      "prompt": "Question about the position (1 sentence)",
-      "choices": [
-        {{"text": "Correct answer with brief reason", "isCorrect": true}},
-        {{"text": "Wrong answer 1", "isCorrect": false}},
-        {{"text": "Wrong answer 2", "isCorrect": false}}
-      ],
-      "correctIndex": 0,
-      "explanation": "1-2 sentence explanation of why the correct answer is right",
-      "boardHighlightsOnReveal": ["e4"],
-      "arrowsOnReveal": [{{"from": "e2", "to": "e4"}}]
-    }}
-  ],
-  "theoryLessons": [
-    {{
-      "title": "Variation Name (ECO code if known)",
-      "description": "2-3 sentence explanation of this variation",
-      "fen": "USE AN EXACT FEN",
-      "highlights": ["c5", "d4"],
-      "arrows": [{{"from": "c7", "to": "c5"}}],
-      "style": "theory"
-    }}
-  ],
-  "theoryQuizzes": [
-    {{
-      "fen": "USE AN EXACT FEN",
-      "prompt": "Question about variations/theory",
-      "choices": [
-        {{"text": "Correct answer", "isCorrect": true}},
-        {{"text": "Wrong answer 1", "isCorrect": false}},
-        {{"text": "Wrong answer 2", "isCorrect": false}}
-      ],
-      "correctIndex": 0,
-      "explanation": "Why this is correct",
-      "boardHighlightsOnReveal": ["d4"],
-      "arrowsOnReveal": []
-    }}
-  ]
-}}
+def generate_lessons_and_quizzes(client, opening: Opening, main: MainLine) -> dict:
+    """Generate planLessons, planQuizzes, theoryLessons, theoryQuizzes."""
+    if client is None:
+        return _placeholder_lessons(opening, main)
 
-Requirements:
-- 3-5 planLessons (concepts: center control, piece development, king safety, pawn structure, common mistakes)
-- 2-3 planQuizzes
-- 2-4 theoryLessons (one per major variation)
-- 2 theoryQuizzes
-- ALL FEN strings MUST be exact copies from the positions listed above
-- highlights and arrows use algebraic squares (e.g., "e4", "d5")
-- style is one of: "good", "bad", "theory"
-- Use beginner-friendly language throughout"""
+    prompt = _lessons_prompt(opening, main)
 
     try:
-        text = call_claude(client, prompt, max_tokens=4000)
+        text = call_claude(client, prompt, max_tokens=MAX_TOKENS["lessons"])
         result = extract_json_from_response(text)
         return result
     except Exception as e:
-        print(f"  WARNING: Lessons generation failed: {e}")
-        return _placeholder_lessons(opening)
+        print(f"  [{opening.id}] WARNING: Lessons generation failed: {e}")
+        return _placeholder_lessons(opening, main)
 
 
-def _placeholder_lessons(opening: dict) -> dict:
+def _placeholder_lessons(opening: Opening, main: MainLine) -> dict:
     """Placeholder lessons when API is unavailable."""
-    # Get a FEN from the main line
-    board = chess.Board()
-    for uci in opening["main_line"][:2]:
-        board.push(chess.Move.from_uci(uci))
-    fen_early = board.fen()
-
-    for uci in opening["main_line"][2:min(6, len(opening["main_line"]))]:
-        board.push(chess.Move.from_uci(uci))
-    fen_mid = board.fen()
+    # Get FENs from the main line
+    fen_early = main.boards[min(2, len(opening.main_line))].fen()
+    fen_mid = main.boards[min(6, len(opening.main_line))].fen()
 
     return {
         "planLessons": [
             {
-                "title": f"Introduction to the {opening['name']}",
-                "description": f"The {opening['name']} is characterized by specific move orders that lead to unique pawn structures and plans.",
+                "title": f"Introduction to the {opening.name}",
+                "description": f"The {opening.name} is characterized by specific move orders that lead to unique pawn structures and plans.",
                 "fen": fen_early,
                 "highlights": [],
                 "arrows": [],
@@ -1422,14 +1763,14 @@ def _placeholder_lessons(opening: dict) -> dict:
         "planQuizzes": [
             {
                 "fen": fen_mid,
-                "prompt": f"What is the main idea behind the {opening['name']}?",
+                "prompt": f"What is the main idea behind the {opening.name}?",
                 "choices": [
                     {"text": "Control the center and develop pieces", "isCorrect": True},
                     {"text": "Attack immediately", "isCorrect": False},
                     {"text": "Move pawns as far as possible", "isCorrect": False},
                 ],
                 "correctIndex": 0,
-                "explanation": f"The {opening['name']} focuses on sound development and central control.",
+                "explanation": f"The {opening.name} focuses on sound development and central control.",
                 "boardHighlightsOnReveal": [],
                 "arrowsOnReveal": [],
             },
@@ -1439,27 +1780,53 @@ def _placeholder_lessons(opening: dict) -> dict:
     }
 
 
-def generate_opponent_responses(client, opening: dict) -> dict | None:
-    """Generate the opponent response catalogue."""
-    response_ply = opening.get("response_after_ply")
+def _response_position(opening: Opening, main: MainLine, limit: int | None = None):
+    """Return (after_moves, board, san_by_uci) at the response point, or None if there is none.
+
+    san_by_uci covers every legal move, or only the first `limit` of them.
+    """
+    response_ply = opening.response_after_ply
     if response_ply is None:
         return None
 
-    main_line = opening["main_line"]
-    after_moves = main_line[:response_ply]
+    after_moves = list(opening.main_line[:response_ply])
 
-    # Get the board position at the response point
-    board = chess.Board()
-    for uci in after_moves:
-        board.push(chess.Move.from_uci(uci))
+    # Private copy of the response position: board.san() pushes and pops,
+    # and the cached boards are read concurrently by the other stages
+    board = main.boards[len(after_moves)].copy(stack=False)
 
-    # Get legal moves for the side to move
-    legal_moves = list(board.legal_moves)
-    if not legal_moves:
+    # Get the SAN for each legal move of the side to move, once
+    san_by_uci = {m.uci(): board.san(m) for m in islice(board.legal_moves, limit)}
+    if not san_by_uci:
         return None
+    return after_moves, board, san_by_uci
 
-    # Get the SAN for each legal move
-    move_sans = [(m.uci(), board.san(m)) for m in legal_moves[:10]]
+
+def _responses_prompt(opening: Opening, main: MainLine, after_moves: list[str],
+                      board: chess.Board, move_sans: list[tuple[str, str]]) -> str:
+    """Build the opponent responses prompt for the position after after_moves."""
+    move_list = ", ".join(f"{san} ({uci})" for uci, san in move_sans[:8])
+    game_so_far = numbered_notation(san for _, san, _ in main.moves[:len(after_moves)])
+
+    return RESPONSES_PROMPT.format(
+        name=opening.name,
+        moves=game_so_far,
+        fen=board.fen(),
+        legal_moves=move_list,
+    )
+
+
+def generate_opponent_responses(client, opening: Opening, main: MainLine) -> dict | None:
+    """Generate the opponent response catalogue."""
+    # Placeholder responses only use the first four legal moves
+    position = _response_position(opening, main, limit=4 if client is None else None)
+    if position is None:
+        return None
+    after_moves, board, san_by_uci = position
+
+    response_ply = opening.response_after_ply
+    main_line = opening.main_line
+    move_sans = list(san_by_uci.items())[:10]
 
     # The main line continuation
     main_next = main_line[response_ply] if response_ply < len(main_line) else None
@@ -1470,7 +1837,7 @@ def generate_opponent_responses(client, opening: dict) -> dict | None:
         for i, (uci, san) in enumerate(move_sans[:4]):
             is_main = (uci == main_next) if main_next else (i == 0)
             responses.append({
-                "id": f"{opening['id']}-resp-{i}",
+                "id": f"{opening.id}-resp-{i}",
                 "move": {"uci": uci, "san": san, "explanation": f"Opponent plays {san}."},
                 "name": san,
                 "eco": "",
@@ -1481,70 +1848,28 @@ def generate_opponent_responses(client, opening: dict) -> dict | None:
         return {"afterMoves": after_moves, "responses": responses}
 
     # Use Claude to identify and describe the main opponent responses
-    move_list = ", ".join(f"{san} ({uci})" for uci, san in move_sans[:8])
-    game_so_far = ""
-    b = chess.Board()
-    for i, uci in enumerate(after_moves):
-        m = chess.Move.from_uci(uci)
-        san = b.san(m)
-        if i % 2 == 0:
-            game_so_far += f"{i//2 + 1}. {san} "
-        else:
-            game_so_far += f"{san} "
-        b.push(m)
-
-    prompt = f"""In the {opening['name']} opening, after the moves: {game_so_far.strip()}
-
-The position FEN is: {board.fen()}
-
-Legal moves include: {move_list}
-
-Identify the 3-4 most important/common opponent responses and return ONLY valid JSON:
-[
-  {{
-    "uci": "exact uci from the list",
-    "san": "exact san from the list",
-    "name": "Standard opening variation name",
-    "eco": "ECO code (e.g., C54)",
-    "frequency": 0.40,
-    "description": "1 sentence beginner-friendly description",
-    "explanation": "1 sentence explaining why the opponent plays this",
-    "planAdjustment": "1 sentence on how to adjust your plan"
-  }}
-]
-
-Requirements:
-- Frequencies should sum to roughly 1.0
-- Use EXACT uci and san strings from the legal moves list above
-- Use standard opening names where applicable
-- Be specific about plan adjustments"""
+    prompt = _responses_prompt(opening, main, after_moves, board, move_sans)
 
     try:
-        text = call_claude(client, prompt, max_tokens=2000)
+        text = call_claude(client, prompt, max_tokens=MAX_TOKENS["responses"])
         resp_list = extract_json_from_response(text)
 
         responses = []
         for i, r in enumerate(resp_list):
             uci = r.get("uci", "")
             san = r.get("san", "")
-            # Validate the move
-            try:
-                move = chess.Move.from_uci(uci)
-                if move not in board.legal_moves:
-                    # Try to find the move by SAN
-                    try:
-                        move = board.parse_san(san)
-                        uci = move.uci()
-                    except Exception:
-                        continue
-            except Exception:
-                continue
+            # Validate the move against the legal moves, else find it by SAN
+            if uci not in san_by_uci:
+                try:
+                    uci = board.parse_san(san).uci()
+                except Exception:
+                    continue
 
             responses.append({
-                "id": f"{opening['id']}-{uci.replace(' ', '')}",
+                "id": f"{opening.id}-{uci.replace(' ', '')}",
                 "move": {
                     "uci": uci,
-                    "san": board.san(move),
+                    "san": san_by_uci[uci],
                     "explanation": r.get("explanation", f"Opponent plays {san}."),
                 },
                 "name": r.get("name", san),
@@ -1559,10 +1884,31 @@ Requirements:
 
         return {"afterMoves": after_moves, "responses": responses}
     except Exception as e:
-        print(f"  WARNING: Opponent response generation failed: {e}")
+        print(f"  [{opening.id}] WARNING: Opponent response generation failed: {e}")
         return None
 
 
+# ---------------------------------------------------------------------------
+# Output
+# ---------------------------------------------------------------------------
+
+def needs_generation(output_path: Path) -> bool:
+    """Return True unless output_path holds real (non-placeholder) JSON at the current SCHEMA_VERSION.
+
+    Callers already know the file exists (from a directory scan); a file that
+    has since vanished or fails to parse counts as needing generation.
+    """
+    try:
+        data = decode_json(output_path.read_bytes())
+    except Exception:
+        return True
+    return (
+        not isinstance(data, dict)
+        or data.get("schemaVersion") != SCHEMA_VERSION
+        or data.get("placeholder", False)
+    )
+
+
 # ---------------------------------------------------------------------------
 # Progress tracking
 # ---------------------------------------------------------------------------
@@ -1571,9 +1917,8 @@ def load_progress() -> set:
     """Load set of completed opening IDs from progress file."""
     if PROGRESS_FILE.exists():
         try:
-            with open(PROGRESS_FILE) as f:
-                data = json.load(f)
-                return set(data.get("completed", []))
+            data = decode_json(PROGRESS_FILE.read_bytes())
+            return set(data.get("completed", []))
         except Exception:
             pass
     return set()
@@ -1581,36 +1926,38 @@ def load_progress() -> set:
 
 def save_progress(completed: set):
     """Save completed opening IDs to progress file."""
-    with open(PROGRESS_FILE, "w") as f:
-        json.dump({"completed": sorted(completed)}, f, indent=2)
+    write_json(PROGRESS_FILE, {"completed": sorted(completed)}, pretty=True)
 
 
 # ---------------------------------------------------------------------------
 # Main generation
 # ---------------------------------------------------------------------------
 
-def generate_opening_json(opening: dict, client, skip_api: bool = False) -> dict:
+def generate_opening_json(opening: Opening, client, skip_api: bool = False) -> dict:
     """Generate a complete opening JSON structure."""
     print(f"\n{'='*60}")
-    print(f"Generating: {opening['name']} ({opening['id']})")
+    print(f"Generating: {opening.name} ({opening.id})")
     print(f"{'='*60}")
 
-    # 1. Build and validate the tree
-    print("  [1/5] Building move tree...")
-    tree = build_tree(opening)
+    # 1. Validate the main line once, then build the tree from it
+    print(f"  [{opening.id}] [1/5] Building move tree...")
+    main = validate_main_line(opening.main_line)
+    tree = build_tree(opening, main)
 
-    # 2. Generate move explanations
+    # 2-5. The content stages only read the opening, main line and tree, so
+    # their Claude calls run concurrently; call_claude() still enforces the
+    # shared concurrency and rate limits.
     api_client = None if skip_api else client
-    print("  [2/5] Generating move explanations...")
-    tree = generate_move_explanations(api_client, opening, tree)
-
-    # 3. Generate plan
-    print("  [3/5] Generating opening plan...")
-    plan = generate_plan(api_client, opening)
-
-    # 4. Generate lessons and quizzes
-    print("  [4/5] Generating lessons and quizzes...")
-    lessons = generate_lessons_and_quizzes(api_client, opening)
+    print(f"  [{opening.id}] [2-5/5] Generating move explanations, plan, lessons and opponent responses...")
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        tree_future = executor.submit(generate_move_explanations, api_client, opening, tree)
+        plan_future = executor.submit(generate_plan, api_client, opening, main)
+        lessons_future = executor.submit(generate_lessons_and_quizzes, api_client, opening, main)
+        responses_future = executor.submit(generate_opponent_responses, api_client, opening, main)
+    tree = tree_future.result()
+    plan = plan_future.result()
+    lessons = lessons_future.result()
+    opponent_responses = responses_future.result()
 
     # Merge lessons into plan
     plan["planLessons"] = lessons.get("planLessons", [])
@@ -1618,17 +1965,14 @@ def generate_opening_json(opening: dict, client, skip_api: bool = False) -> dict
     plan["theoryLessons"] = lessons.get("theoryLessons", [])
     plan["theoryQuizzes"] = lessons.get("theoryQuizzes", [])
 
-    # 5. Generate opponent responses
-    print("  [5/5] Generating opponent responses...")
-    opponent_responses = generate_opponent_responses(api_client, opening)
-
     # Assemble final JSON
     result = {
-        "id": opening["id"],
-        "name": opening["name"],
-        "description": opening["description"],
-        "color": opening["color"],
-        "difficulty": opening["difficulty"],
+        "schemaVersion": SCHEMA_VERSION,
+        "id": opening.id,
+        "name": opening.name,
+        "description": opening.description,
+        "color": opening.color,
+        "difficulty": opening.difficulty,
         "tree": tree,
         "plan": plan,
     }
@@ -1636,16 +1980,82 @@ def generate_opening_json(opening: dict, client, skip_api: bool = False) -> dict
     if opponent_responses:
         result["opponentResponses"] = opponent_responses
 
+    # Placeholder content is never treated as up to date on a later run
+    if api_client is None:
+        result["placeholder"] = True
+
     return result
 
 
+def collect_prompts(opening: Opening) -> list[tuple[str, str]]:
+    """Return (stage, prompt) for every Claude call generate_opening_json() makes for opening."""
+    main = validate_main_line(opening.main_line)
+    tree = build_tree(opening, main)
+
+    prompts = []
+    moves_info = _explanation_moves(tree)
+    if moves_info:
+        prompts.append(("explanations", _explanations_prompt(opening, moves_info)))
+    prompts.append(("plan", _plan_prompt(opening, main)))
+    prompts.append(("lessons", _lessons_prompt(opening, main)))
+    position = _response_position(opening, main)
+    if position is not None:
+        after_moves, board, san_by_uci = position
+        move_sans = list(san_by_uci.items())[:10]
+        prompts.append(("responses", _responses_prompt(opening, main, after_moves, board, move_sans)))
+    return prompts
+
+
+def run_batch(client, openings: list[Opening]) -> BatchResults:
+    """Send every prompt for openings as one Message Batch and wait for the results.
+
+    Batches are processed asynchronously (usually within minutes, at most 24
+    hours) at half the per-token price, and need no client-side rate limiting.
+    """
+    prompt_by_id = {}
+    requests = []
+    for opening in openings:
+        for stage, prompt in collect_prompts(opening):
+            custom_id = f"{opening.id}-{stage}"
+            prompt_by_id[custom_id] = prompt
+            requests.append({"custom_id": custom_id, "params": message_params(prompt, MAX_TOKENS[stage])})
+
+    batch = client.messages.batches.create(requests=requests)
+    print(f"\nSubmitted batch {batch.id} with {len(requests)} requests")
+    while batch.processing_status != "ended":
+        time.sleep(BATCH_POLL_INTERVAL)
+        batch = client.messages.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        print(f"  Batch {batch.id}: {counts.processing} processing, {counts.succeeded} succeeded, "
+              f"{counts.errored + counts.canceled + counts.expired} failed")
+
+    texts = {}
+    errors = {}
+    for entry in client.messages.batches.results(batch.id):
+        prompt = prompt_by_id[entry.custom_id]
+        if entry.result.type == "succeeded":
+            _cache_stats.add(entry.result.message.usage)
+            texts[prompt] = "".join(
+                block.text for block in entry.result.message.content if block.type == "text"
+            )
+        else:
+            errors[prompt] = f"Batch request {entry.custom_id} {entry.result.type}"
+    return BatchResults(texts, errors)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Generate all opening JSON files for ChessCoach")
     parser.add_argument("--dry-run", action="store_true", help="Only validate moves, don't generate content")
+    parser.add_argument("--fail-fast", action="store_true", help="With --dry-run, stop at the first invalid line")
     parser.add_argument("--skip-api", action="store_true", help="Skip Claude API calls, use placeholders")
     parser.add_argument("--only", type=str, help="Comma-separated list of opening IDs to generate")
     parser.add_argument("--force", action="store_true", help="Regenerate even if JSON already exists")
     parser.add_argument("--no-resume", action="store_true", help="Don't resume from previous progress")
+    parser.add_argument("--pretty", action="store_true", help="Write indented JSON (for local debugging)")
+    parser.add_argument("--workers", type=int, default=API_CONCURRENCY,
+                        help=f"Number of openings to generate in parallel (default: {API_CONCURRENCY})")
+    parser.add_argument("--batch", action="store_true",
+                        help="Send all Claude calls as one Message Batch and wait for it to finish")
     args = parser.parse_args()
 
     # Check for API key
@@ -1665,7 +2075,7 @@ def main():
     openings_to_generate = OPENINGS
     if args.only:
         only_ids = set(args.only.split(","))
-        openings_to_generate = [o for o in OPENINGS if o["id"] in only_ids]
+        openings_to_generate = [o for o in OPENINGS if o.id in only_ids]
         if not openings_to_generate:
             print(f"Error: No openings found matching: {args.only}")
             sys.exit(1)
@@ -1677,33 +2087,17 @@ def main():
     if args.dry_run:
         print("DRY RUN: Validating all move sequences...\n")
         errors = 0
-        for opening in openings_to_generate:
-            print(f"  {opening['name']} ({opening['id']})...")
-            try:
-                validate_moves(opening["main_line"])
-                print(f"    Main line: OK ({len(opening['main_line'])} moves)")
-            except ValueError as e:
-                print(f"    Main line: FAILED - {e}")
-                errors += 1
-
-            for var in opening.get("variations", []):
-                try:
-                    # Validate main line up to branch point
-                    partial = opening["main_line"][:var["branch_ply"]]
-                    validate_moves(partial)
-                    # Then validate variation from that point
-                    board = chess.Board()
-                    for uci in partial:
-                        board.push(chess.Move.from_uci(uci))
-                    for uci in var["moves"]:
-                        m = chess.Move.from_uci(uci)
-                        if m not in board.legal_moves:
-                            raise ValueError(f"Illegal: {uci} in {board.fen()}")
-                        board.push(m)
-                    print(f"    {var['name']}: OK ({len(var['moves'])} moves from ply {var['branch_ply']})")
-                except ValueError as e:
-                    print(f"    {var['name']}: FAILED - {e}")
-                    errors += 1
+        # Validation is CPU-bound python-chess work, so fan openings out
+        # across processes; map() yields reports lazily in opening order, so
+        # --fail-fast can stop consuming and cancel the openings not yet started.
+        validate = partial(validate_opening, fail_fast=args.fail_fast)
+        with ProcessPoolExecutor() as executor:
+            for lines, opening_errors in executor.map(validate, openings_to_generate, chunksize=4):
+                print("\n".join(lines))
+                errors += opening_errors
+                if errors and args.fail_fast:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    break
 
         if errors:
             print(f"\n{errors} error(s) found.")
@@ -1722,46 +2116,77 @@ def main():
     skipped = 0
     failed = 0
 
+    # One directory listing instead of a stat per opening
+    existing_files = {entry.name for entry in os.scandir(OUTPUT_DIR) if entry.is_file()}
+
+    pending = []
     for opening in openings_to_generate:
-        oid = opening["id"]
+        oid = opening.id
 
         # Skip existing JSON files (italian, london)
         output_path = OUTPUT_DIR / f"{oid}.json"
-        if oid in EXISTING_IDS and output_path.exists() and not args.force:
-            print(f"\nSkipping {opening['name']} (existing JSON)")
+        exists = output_path.name in existing_files
+        if oid in EXISTING_IDS and exists and not args.force:
+            print(f"\nSkipping {opening.name} (existing JSON)")
+            skipped += 1
+            continue
+
+        # When resuming, skip openings a previous run already wrote with real
+        # content at the current schema
+        if not args.force and not args.no_resume and exists and not needs_generation(output_path):
+            print(f"\nSkipping {opening.name} (up-to-date JSON)")
             skipped += 1
             continue
 
         # Skip if already completed in this run
         if oid in completed and not args.force:
-            print(f"\nSkipping {opening['name']} (already completed)")
+            print(f"\nSkipping {opening.name} (already completed)")
             skipped += 1
             continue
 
-        try:
-            result = generate_opening_json(opening, client, args.skip_api)
+        pending.append(opening)
+
+    # In batch mode every prompt is answered up front; the generation pass
+    # below then reads the responses from the batch instead of the API.
+    if args.batch and client is not None and pending:
+        client = run_batch(client, pending)
+
+    # Openings are generated on worker threads so one opening's network waits
+    # overlap with another's tree building; call_claude() enforces the shared
+    # concurrency and rate limits. Threads rather than processes, because the
+    # work is network-bound and the limits and client must be shared.
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {
+            executor.submit(generate_opening_json, opening, client, args.skip_api): opening
+            for opening in pending
+        }
+        for future in as_completed(futures):
+            opening = futures[future]
+            output_path = OUTPUT_DIR / f"{opening.id}.json"
+            try:
+                result = future.result()
 
-            # Write output
-            with open(output_path, "w") as f:
-                json.dump(result, f, indent=2)
+                # Write output
+                write_json(output_path, result, pretty=args.pretty)
 
-            print(f"  Written: {output_path}")
-            generated += 1
+                print(f"  Written: {output_path}")
+                generated += 1
 
-            # Save progress
-            completed.add(oid)
-            save_progress(completed)
+                # Save progress
+                completed.add(opening.id)
+                save_progress(completed)
 
-        except Exception as e:
-            print(f"  ERROR generating {opening['name']}: {e}")
-            import traceback
-            traceback.print_exc()
-            failed += 1
-            continue
+            except Exception as e:
+                print(f"  ERROR generating {opening.name}: {e}")
+                traceback.print_exc()
+                failed += 1
+                continue
 
     print(f"\n{'='*60}")
     print(f"Done! Generated: {generated}, Skipped: {skipped}, Failed: {failed}")
     print(f"Output directory: {OUTPUT_DIR}")
+    if _cache_stats.calls:
+        print(_cache_stats.summary())
     print(f"{'='*60}")
 
 
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 """
 Build-time script: generates per-move coaching explanations for opening trees.
-Reads a polyglot .bin book, builds trees, sends batched prompts to Claude API,
-and outputs JSON files per opening bundled with the app.
+Reads a polyglot .bin book, builds trees, sends one prompt per move to Claude
+through the Message Batches API, and outputs JSON files per opening bundled
+with the app.
 
 Usage:
     python3 generate_explanations.py --book path/to/book.bin --output ChessCoach/Resources/Openings/
@@ -12,6 +13,7 @@ Environment:
 """
 
 import argparse
+import heapq
 import json
 import os
 import struct
@@ -33,6 +35,27 @@ except ImportError:
     print("Warning: anthropic SDK not installed. Will generate placeholder explanations.")
     print("Install with: pip install anthropic")
 
+from script_utils import parse_uci, write_json
+
+
+# Seconds between status checks while an explanations batch is processing
+BATCH_POLL_INTERVAL = 30
+
+# Message Batches limits: requests per batch, and total request size in bytes
+# (kept below the 256 MB cap to leave room for the envelope)
+MAX_BATCH_REQUESTS = 100_000
+MAX_BATCH_BYTES = 200 * 1024 * 1024
+
+# Static instructions shared by every explanation request, sent as the system
+# prompt; only the move itself goes in the user message. They are too short for
+# prompt caching, so no cache_control marker is set.
+SYSTEM_PROMPT_EXPLAIN = """You write move explanations for a chess coaching app.
+
+Write a 1-2 sentence explanation of the move you are given, suitable for a
+beginner chess player (ELO ~800-1200). Explain WHY the move is played, not
+just what it does.
+
+Return only the explanation, no other text."""
 
 # Opening definitions: name, color, starting moves (UCI), difficulty
 OPENINGS = [
@@ -119,20 +142,35 @@ OPENINGS = [
 ]
 
 
-def build_tree_from_book(book_path, start_moves, max_depth=15, max_branch=3, min_weight_frac=0.05):
-    """Build an opening tree from a polyglot book."""
-    reader = chess.polyglot.open_reader(book_path)
+# Filtered book moves per position as (move, san, weight), keyed by book reader,
+# position_key() and filter settings, so transpositions within and across
+# openings reuse one book lookup and one set of SAN conversions.
+_BOOK_MOVES_CACHE = {}
+
+
+def position_key(board):
+    """Cheap hashable key for a position, built from its bitboards.
+
+    Equal positions get equal keys (also with a non-capturable en passant
+    square, unlike a Polyglot hash, which only costs a cache miss). About
+    20x faster than chess.polyglot.zobrist_hash(), which find_all() already
+    computes on a miss.
+    """
+    return (board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings,
+            board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK],
+            board.turn, board.castling_rights, board.ep_square)
+
+
+def build_tree_from_book(reader, start_moves, max_depth=15, max_branch=3, min_weight_frac=0.05):
+    """Build an opening tree from an open polyglot book reader."""
     board = chess.Board()
 
     # Play starting moves
     for uci in start_moves:
-        move = chess.Move.from_uci(uci)
+        move = parse_uci(uci)
         board.push(move)
 
-    def walk(board, depth):
-        if depth >= max_depth:
-            return []
-
+    def book_moves(board):
         try:
             entries = list(reader.find_all(board))
         except Exception:
@@ -145,18 +183,32 @@ def build_tree_from_book(book_path, start_moves, max_depth=15, max_branch=3, min
         if total_weight == 0:
             return []
 
+        # Top max_branch entries by weight in one pass over the survivors
         min_weight = max(1, int(total_weight * min_weight_frac))
-        filtered = [e for e in entries if e.weight >= min_weight]
-        filtered.sort(key=lambda e: e.weight, reverse=True)
-        filtered = filtered[:max_branch]
+        filtered = heapq.nlargest(max_branch, (e for e in entries if e.weight >= min_weight),
+                                  key=lambda e: e.weight)
+        # SAN is filled in by walk() via san_and_push(), which saves the
+        # push/pop board.san() would do internally.
+        return [[e.move, None, e.weight] for e in filtered]
+
+    def walk(board, depth):
+        if depth >= max_depth:
+            return []
+
+        key = (reader, position_key(board), max_branch, min_weight_frac)
+        moves = _BOOK_MOVES_CACHE.get(key)
+        if moves is None:
+            moves = _BOOK_MOVES_CACHE[key] = book_moves(board)
 
         children = []
-        for i, entry in enumerate(filtered):
-            move = entry.move
-            san = board.san(move)
+        for i, entry in enumerate(moves):
+            move, san, weight = entry
             uci = move.uci()
 
-            board.push(move)
+            if san is None:
+                entry[1] = san = board.san_and_push(move)
+            else:
+                board.push(move)
             sub_children = walk(board, depth + 1)
             board.pop()
 
@@ -168,106 +220,142 @@ def build_tree_from_book(book_path, start_moves, max_depth=15, max_branch=3, min
                 },
                 "children": sub_children,
                 "isMainLine": i == 0,
-                "weight": entry.weight,
+                "weight": weight,
             }
             children.append(node)
 
         return children
 
-    tree = walk(board, 0)
-    reader.close()
-    return tree
+    return walk(board, 0)
 
 
 def count_nodes(tree):
     """Count total nodes in a tree."""
-    count = len(tree)
-    for node in tree:
-        count += count_nodes(node.get("children", []))
+    count = 0
+    stack = list(tree)
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.get("children", ()))
     return count
 
 
 def collect_positions(tree, board, start_moves):
-    """Collect all (position_desc, move_san, node_path) tuples for explanation generation."""
-    board_copy = chess.Board()
-    for uci in start_moves:
-        board_copy.push(chess.Move.from_uci(uci))
+    """Collect all (position_desc, move_san, node_path) tuples for explanation generation.
+
+    The move history is carried down the walk as numbered move text
+    ("1. e4 e5 2. Nf3"), extended by one move per ply, so each position_desc
+    is built in constant time.
+    """
+    def extend(prefix, ply, san):
+        if ply % 2 == 0:
+            san = f"{ply//2+1}. {san}"
+        return f"{prefix} {san}" if prefix else san
+
+    # Seed the history with the start moves, in SAN like the tree moves
+    start_board = chess.Board()
+    start_prefix = ""
+    for ply, uci in enumerate(start_moves):
+        start_prefix = extend(start_prefix, ply, start_board.san_and_push(parse_uci(uci)))
 
     positions = []
 
-    def walk(nodes, move_history):
+    def walk(nodes, ply, prefix):
         for node in nodes:
             move = node["move"]
             san = move["san"]
-            uci_str = move["uci"]
-
-            pos_desc = " ".join(
-                f"{i//2+1}." + (" " if i % 2 == 0 else "") + m
-                for i, m in enumerate(move_history + [san])
-            )
 
+            position = extend(prefix, ply, san)
             positions.append({
-                "position": pos_desc,
+                "position": position,
                 "san": san,
-                "uci": uci_str,
+                "uci": move["uci"],
                 "node": node,
             })
 
-            board_copy.push(chess.Move.from_uci(uci_str))
-            walk(node.get("children", []), move_history + [san])
-            board_copy.pop()
+            walk(node.get("children", []), ply + 1, position)
 
-    walk(tree, [board_copy.move_stack[i].uci() if i < len(board_copy.move_stack) else "" for i in range(len(start_moves))])
+    walk(tree, len(start_moves), start_prefix)
     return positions
 
 
-def generate_explanations_claude(positions, opening_name, client):
-    """Generate explanations using Claude API in batches."""
-    batch_size = 10
-
-    for i in range(0, len(positions), batch_size):
-        batch = positions[i:i+batch_size]
-
-        moves_text = "\n".join(
-            f"- After {p['position']}: {p['san']}"
-            for p in batch
-        )
-
-        prompt = f"""For the {opening_name} chess opening, write a 1-2 sentence explanation
-for each of these moves, suitable for a beginner chess player (ELO ~800-1200).
-Explain WHY the move is played, not just what it does.
-
-Moves to explain:
-{moves_text}
-
-Return a JSON array of strings, one explanation per move, in the same order.
-Only return the JSON array, no other text."""
+def explanation_prompt(position, opening_name):
+    """Build the user message asking for one move's explanation."""
+    return f"""Opening: {opening_name}
+Move to explain: after {position['position']}: {position['san']}"""
+
+
+def batch_chunks(requests):
+    """Split batch requests into chunks within the Message Batches count and size limits."""
+    chunk = []
+    size = 0
+    for request in requests:
+        request_size = len(json.dumps(request))
+        if chunk and (len(chunk) >= MAX_BATCH_REQUESTS or size + request_size > MAX_BATCH_BYTES):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(request)
+        size += request_size
+    if chunk:
+        yield chunk
+
+
+def run_explanation_batch(client, requests, by_id):
+    """Submit one batch of explanation requests and apply the results.
+
+    Returns the number of requests that failed.
+    """
+    batch = client.messages.batches.create(requests=requests)
+    print(f"\nSubmitted batch {batch.id} with {len(requests)} explanation requests")
+    while batch.processing_status != "ended":
+        time.sleep(BATCH_POLL_INTERVAL)
+        batch = client.messages.batches.retrieve(batch.id)
+        print(f"  {batch.request_counts.succeeded} succeeded, {batch.request_counts.processing} processing")
+
+    failed = 0
+    for entry in client.messages.batches.results(batch.id):
+        if entry.result.type == "succeeded":
+            text = entry.result.message.content[0].text.strip()
+            by_id[entry.custom_id]["node"]["move"]["explanation"] = text
+        else:
+            failed += 1
+    return failed
+
+
+def generate_explanations_claude(openings_positions, client):
+    """Generate explanations for every position of every opening through Message Batches.
+
+    openings_positions is a list of (opening_name, positions) pairs. Each move
+    is its own batch request, split into as few batches as the API limits
+    allow; moves whose request or batch fails keep a generic explanation.
+    """
+    requests = []
+    by_id = {}
+    for opening_name, positions in openings_positions:
+        for p in positions:
+            p["node"]["move"]["explanation"] = f"A key move in the {opening_name}."
+            custom_id = f"move-{len(requests)}"
+            by_id[custom_id] = p
+            requests.append({
+                "custom_id": custom_id,
+                "params": {
+                    "model": "claude-sonnet-4-20250514",
+                    "max_tokens": 300,
+                    "system": SYSTEM_PROMPT_EXPLAIN,
+                    "messages": [{"role": "user", "content": explanation_prompt(p, opening_name)}],
+                },
+            })
 
+    failed = 0
+    for chunk in batch_chunks(requests):
         try:
-            response = client.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=2000,
-                messages=[{"role": "user", "content": prompt}]
-            )
-
-            text = response.content[0].text.strip()
-            # Parse JSON from response
-            if text.startswith("```"):
-                text = text.split("\n", 1)[1].rsplit("```", 1)[0]
-
-            explanations = json.loads(text)
-
-            for j, explanation in enumerate(explanations):
-                if j < len(batch):
-                    batch[j]["node"]["move"]["explanation"] = explanation
-
-            # Rate limiting
-            time.sleep(1)
-
+            failed += run_explanation_batch(client, chunk, by_id)
         except Exception as e:
-            print(f"  Warning: Claude API error for batch {i}: {e}")
-            for p in batch:
-                p["node"]["move"]["explanation"] = f"A key move in the {opening_name}."
+            print(f"  Warning: explanation batch failed: {e}")
+            failed += len(chunk)
+    if failed:
+        print(f"  Warning: {failed} explanation request(s) failed; using generic explanations")
 
 
 def generate_placeholder_explanations(positions, opening_name):
@@ -279,10 +367,12 @@ def generate_placeholder_explanations(positions, opening_name):
 
 def assign_node_ids(tree, prefix=""):
     """Assign stable IDs to all nodes in the tree."""
-    for i, node in enumerate(tree):
+    stack = [(prefix, node) for node in tree]
+    while stack:
+        prefix, node = stack.pop()
         node_id = f"{prefix}/{node['move']['uci']}" if prefix else node["move"]["uci"]
         node["id"] = node_id
-        assign_node_ids(node.get("children", []), node_id)
+        stack.extend((node_id, child) for child in node.get("children", ()))
 
 
 def main():
@@ -305,12 +395,16 @@ def main():
         else:
             print("Warning: ANTHROPIC_API_KEY not set, using placeholder explanations")
 
+    # Build every tree first so all explanations go out in a single batch.
+    # The book is opened once and shared by every opening.
+    reader = chess.polyglot.open_reader(args.book)
+    built = []
     for opening in OPENINGS:
         print(f"\nProcessing: {opening['name']}")
 
         # Build tree
         tree = build_tree_from_book(
-            args.book,
+            reader,
             opening["start_moves"],
             max_depth=args.max_depth,
             max_branch=args.max_branch,
@@ -326,15 +420,19 @@ def main():
         # Assign IDs
         assign_node_ids(tree, opening["id"])
 
-        # Generate explanations
         positions = collect_positions(tree, None, opening["start_moves"])
         print(f"  Positions to explain: {len(positions)}")
+        built.append((opening, tree, positions))
+    reader.close()
 
-        if client:
-            generate_explanations_claude(positions, opening["name"], client)
-        else:
+    # Generate explanations
+    if client:
+        generate_explanations_claude([(opening["name"], positions) for opening, _, positions in built], client)
+    else:
+        for opening, _, positions in built:
             generate_placeholder_explanations(positions, opening["name"])
 
+    for opening, tree, _ in built:
         # Build the start moves with explanations (from hardcoded data)
         start_tree = []
         for uci in opening["start_moves"]:
@@ -363,8 +461,7 @@ def main():
 
         # Write JSON
         output_path = os.path.join(args.output, f"{opening['id']}.json")
-        with open(output_path, "w") as f:
-            json.dump(root, f, indent=2)
+        write_json(output_path, root, pretty=True)
 
         print(f"  Written to: {output_path}")
 
@@ -14,16 +14,17 @@ Usage:
     python3 generate_opening.py --opening "Italian Game" --book path/to/book.bin --output ChessCoach/Resources/Openings/
     python3 generate_opening.py --eco C50 --book path/to/book.bin --output ChessCoach/Resources/Openings/
     python3 generate_opening.py --all --book path/to/book.bin --tsv path/to/lichess.tsv --output ChessCoach/Resources/Openings/
+    python3 generate_opening.py --all --workers 8 --book path/to/book.bin --output ChessCoach/Resources/Openings/
 
 Environment:
     ANTHROPIC_API_KEY - Claude API key for generating plans and explanations
 """
 
 import argparse
-import json
 import os
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 try:
@@ -40,6 +41,46 @@ except ImportError:
     anthropic = None
     print("Warning: anthropic SDK not installed. Will generate placeholder content.")
 
+from script_utils import decode_json, parse_uci, write_json
+
+# Static instructions for each Claude call. They go in the system prompt so the
+# user message carries only the opening-specific part. They are too short for
+# prompt caching, so no cache_control marker is set.
+SYSTEM_PROMPT_PLAN = """You write opening plans for a chess coaching app for beginners.
+
+Return ONLY valid JSON matching this schema:
+{
+  "summary": "1-2 sentence description of what you're trying to achieve",
+  "strategicGoals": [
+    {"description": "specific goal", "priority": 1},
+    {"description": "specific goal", "priority": 2},
+    {"description": "specific goal", "priority": 3},
+    {"description": "specific goal", "priority": 4}
+  ],
+  "pawnStructureTarget": "description of ideal pawn structure",
+  "keySquares": ["e4", "f7"],
+  "pieceTargets": [
+    {"piece": "piece name", "idealSquares": ["c4", "b3"], "reasoning": "why"}
+  ],
+  "typicalPlans": ["middlegame plan 1", "middlegame plan 2"],
+  "commonMistakes": ["mistake 1", "mistake 2", "mistake 3"],
+  "historicalNote": "brief historical context"
+}
+
+Be specific to the opening you are given. Use beginner-friendly language."""
+
+SYSTEM_PROMPT_ENRICH = """You describe the opponent's main responses in chess openings.
+
+You are given several openings, each with its id and the opponent's main
+responses after its standard moves. For each response, provide:
+1. The standard opening name (e.g., "Giuoco Piano", "Two Knights Defense")
+2. The ECO code
+3. A beginner-friendly description (1 sentence)
+4. How the player should adjust their plan (1 sentence)
+
+Return ONLY a JSON object mapping each opening id to an array:
+{"italian": [{"san": "Bc5", "name": "Opening Name", "eco": "C54", "description": "...", "planAdjustment": "..."}]}"""
+
 # Priority openings (matches the built-in list)
 PRIORITY_OPENINGS = [
     {"id": "italian", "name": "Italian Game", "eco_range": ("C50", "C54"), "color": "white", "difficulty": 1,
@@ -67,84 +108,178 @@ PRIORITY_OPENINGS = [
 
 def uci_to_move(board, uci_str):
     """Convert UCI string to chess.Move."""
-    return chess.Move.from_uci(uci_str)
+    return parse_uci(uci_str)
 
 
-def build_tree_from_polyglot(book_path, start_moves, max_depth=12, min_weight=5):
-    """Build an opening tree from polyglot book data."""
-    reader = chess.polyglot.open_reader(book_path)
-    board = chess.Board()
+# Book moves kept for each position as (is_main_line, move, san, weight), keyed
+# by book reader, position_key() and min_weight, so transpositions within and
+# across openings reuse one book lookup and one set of SAN conversions.
+_BOOK_MOVES_CACHE = {}
 
-    # Apply starting moves
-    for uci in start_moves:
-        board.push(uci_to_move(board, uci))
 
-    def build_node(board, depth, parent_id):
-        if depth >= max_depth:
-            return []
+def position_key(board):
+    """Cheap hashable key for a position, built from its bitboards.
 
-        children = []
+    Equal positions get equal keys (also with a non-capturable en passant
+    square, unlike a Polyglot hash, which only costs a cache miss). About
+    20x faster than chess.polyglot.zobrist_hash(), which find_all() already
+    computes on a miss.
+    """
+    return (board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings,
+            board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK],
+            board.turn, board.castling_rights, board.ep_square)
+
+
+# Polyglot hashing split as in chess.polyglot.ZobristHasher: the piece keys
+# are kept incrementally while walking the book, the castling, en passant and
+# turn keys are cheap to add on a cache miss.
+_POLYGLOT_HASHER = chess.polyglot.ZobristHasher(chess.polyglot.POLYGLOT_RANDOM_ARRAY)
+
+# Polyglot books encode castling as king-takes-rook
+_POLYGLOT_CASTLING = {
+    (chess.E1, chess.H1): chess.G1, (chess.E1, chess.A1): chess.C1,
+    (chess.E8, chess.H8): chess.G8, (chess.E8, chess.A8): chess.C8,
+}
+
+
+def piece_bitboards(board):
+    """Squares per (piece type, color), in Polyglot piece-key order."""
+    return [bb & occupied
+            for bb in (board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings)
+            for occupied in board.occupied_co]
+
+
+def piece_keys_changed(before, after):
+    """XOR of Polyglot piece keys for squares that differ between two piece_bitboards()."""
+    keys = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+    delta = 0
+    for piece_index, (old, new) in enumerate(zip(before, after)):
+        changed = old ^ new
+        if changed:
+            for square in chess.scan_reversed(changed):
+                delta ^= keys[64 * piece_index + square]
+    return delta
+
+
+def polyglot_key(board, piece_hash):
+    """Full Polyglot hash of board, given the hash of its pieces."""
+    return (piece_hash ^ _POLYGLOT_HASHER.hash_castling(board) ^
+            _POLYGLOT_HASHER.hash_ep_square(board) ^ _POLYGLOT_HASHER.hash_turn(board))
+
+
+def book_move(board, move):
+    """Translate a raw Polyglot book move to the board's move (castling)."""
+    if move.promotion is None and board.kings & chess.BB_SQUARES[move.from_square]:
+        to_square = _POLYGLOT_CASTLING.get((move.from_square, move.to_square))
+        if to_square is not None:
+            return chess.Move(move.from_square, to_square)
+    return move
+
+
+def build_tree_from_polyglot(reader, start_moves, max_depth=12, min_weight=5):
+    """Build an opening tree from an open polyglot book reader."""
+
+    def book_moves(board, piece_hash):
+        # Look up by hash rather than by board, so find_all() does not hash
+        # the whole position again; legality and castling are checked here.
         try:
-            entries = list(reader.find_all(board))
+            entries = []
+            for entry in reader.find_all(polyglot_key(board, piece_hash)):
+                move = book_move(board, entry.move)
+                if board.is_legal(move):
+                    entries.append((move, entry.weight))
         except Exception:
             return []
 
         # Sort by weight descending
-        entries.sort(key=lambda e: e.weight, reverse=True)
+        entries.sort(key=lambda e: e[1], reverse=True)
+
+        # SAN is filled in by build_node() via san_and_push(), which saves
+        # the push/pop board.san() would do internally.
+        return [[i == 0, move, None, weight]
+                for i, (move, weight) in enumerate(entries)
+                if weight >= min_weight or i == 0]
+
+    # Finished subtrees by (position_key, depth), with the parent id they were
+    # built under. A transposition copies the subtree under its own path
+    # instead of walking the book again; the app has no notion of shared
+    # nodes, so every path still gets full nodes with path-based ids.
+    subtrees = {}
+
+    # Copies get their own "move" dicts too, so a later in-place edit of one
+    # node (e.g. its explanation) does not leak into its transpositions.
+    def reparent(nodes, old_id, new_id):
+        return [{**node,
+                 "id": new_id + node["id"][len(old_id):],
+                 "move": dict(node["move"]),
+                 "children": reparent(node["children"], old_id, new_id)}
+                for node in nodes]
+
+    def build_node(board, depth, parent_id, pieces, piece_hash):
+        if depth >= max_depth:
+            return []
 
-        for i, entry in enumerate(entries):
-            if entry.weight < min_weight and i > 0:
-                continue
+        subtree_key = (position_key(board), depth)
+        seen = subtrees.get(subtree_key)
+        if seen is not None:
+            built_under, built = seen
+            return reparent(built, built_under, parent_id)
 
-            move = entry.move
+        key = (reader, position_key(board), min_weight)
+        moves = _BOOK_MOVES_CACHE.get(key)
+        if moves is None:
+            moves = _BOOK_MOVES_CACHE[key] = book_moves(board, piece_hash)
+
+        children = []
+        for entry in moves:
+            is_main_line, move, san, weight = entry
             uci = move.uci()
-            san = board.san(move)
             node_id = f"{parent_id}/{uci}"
 
-            board.push(move)
-            sub_children = build_node(board, depth + 1, node_id)
+            if san is None:
+                entry[2] = san = board.san_and_push(move)
+            else:
+                board.push(move)
+            child_pieces = piece_bitboards(board)
+            sub_children = build_node(board, depth + 1, node_id, child_pieces,
+                                      piece_hash ^ piece_keys_changed(pieces, child_pieces))
             board.pop()
 
             children.append({
                 "id": node_id,
                 "move": {"uci": uci, "san": san, "explanation": ""},
-                "isMainLine": i == 0,
-                "weight": entry.weight,
+                "isMainLine": is_main_line,
+                "weight": weight,
                 "children": sub_children
             })
 
+        subtrees[subtree_key] = (parent_id, children)
         return children
 
     root_id = start_moves[0].replace("e2e4", "root") if start_moves else "root"
 
-    # Build from start position
-    board_from_start = chess.Board()
-    start_nodes = []
-
-    def build_from_start(moves_so_far, remaining_start_moves, parent_id):
-        if not remaining_start_moves:
-            # Now build the tree from polyglot
-            return build_node(board, len(start_moves), parent_id)
-
-        uci = remaining_start_moves[0]
-        move = uci_to_move(board_from_start, uci)
-        san = board_from_start.san(move)
-        node_id = f"{parent_id}/{uci}"
-        board_from_start.push(move)
-
-        sub = build_from_start(moves_so_far + [uci], remaining_start_moves[1:], node_id)
-
-        return [{
-            "id": node_id,
+    # Chain the start moves top-down, then hang the book tree off the last
+    # one, walking the book on the same board the start moves were played on
+    board = chess.Board()
+    parent_id = f"{start_moves[0][:4] if start_moves else 'root'}"
+    tree_children = children = []
+    for i, uci in enumerate(start_moves):
+        san = board.san_and_push(uci_to_move(board, uci))
+        parent_id = f"{parent_id}/{uci}"
+
+        node = {
+            "id": parent_id,
             "move": {"uci": uci, "san": san, "explanation": ""},
             "isMainLine": True,
-            "weight": 300 - len(moves_so_far) * 10,
-            "children": sub
-        }]
+            "weight": 300 - i * 10,
+            "children": []
+        }
+        children.append(node)
+        children = node["children"]
 
-    tree_children = build_from_start([], start_moves, f"{start_moves[0][:4] if start_moves else 'root'}")
+    children.extend(build_node(board, len(start_moves), parent_id,
+                               piece_bitboards(board), _POLYGLOT_HASHER.hash_board(board)))
 
-    reader.close()
     return {
         "id": f"{start_moves[0][:4] if start_moves else 'root'}/root",
         "children": tree_children,
@@ -160,43 +295,23 @@ def generate_plan_with_llm(opening_info):
 
     client = anthropic.Anthropic()
 
-    prompt = f"""Generate an opening plan for the {opening_info['name']} chess opening (played as {opening_info['color']}).
-
-Return ONLY valid JSON matching this schema:
-{{
-  "summary": "1-2 sentence description of what you're trying to achieve",
-  "strategicGoals": [
-    {{"description": "specific goal", "priority": 1}},
-    {{"description": "specific goal", "priority": 2}},
-    {{"description": "specific goal", "priority": 3}},
-    {{"description": "specific goal", "priority": 4}}
-  ],
-  "pawnStructureTarget": "description of ideal pawn structure",
-  "keySquares": ["e4", "f7"],
-  "pieceTargets": [
-    {{"piece": "piece name", "idealSquares": ["c4", "b3"], "reasoning": "why"}}
-  ],
-  "typicalPlans": ["middlegame plan 1", "middlegame plan 2"],
-  "commonMistakes": ["mistake 1", "mistake 2", "mistake 3"],
-  "historicalNote": "brief historical context"
-}}
-
-Be specific to this opening. Use beginner-friendly language."""
+    prompt = f"Generate an opening plan for the {opening_info['name']} chess opening (played as {opening_info['color']})."
 
     try:
         response = client.messages.create(
             model="claude-sonnet-4-20250514",
             max_tokens=1500,
+            system=SYSTEM_PROMPT_PLAN,
             messages=[{"role": "user", "content": prompt}]
         )
         text = response.content[0].text.strip()
         # Extract JSON
         if text.startswith("{"):
-            return json.loads(text)
+            return decode_json(text)
         start = text.find("{")
         end = text.rfind("}") + 1
         if start >= 0 and end > start:
-            return json.loads(text[start:end])
+            return decode_json(text[start:end])
     except Exception as e:
         print(f"  LLM plan generation failed: {e}")
 
@@ -222,18 +337,18 @@ def generate_placeholder_plan(opening_info):
     }
 
 
-def generate_opponent_responses_with_llm(opening_info, board, book_path):
-    """Generate opponent response catalogue from polyglot data + LLM descriptions."""
-    reader = chess.polyglot.open_reader(book_path)
+def generate_opponent_responses_with_llm(opening_info, board, reader):
+    """Generate opponent response catalogue from polyglot data.
 
+    Names and descriptions are placeholders until enrich_responses_with_llm()
+    fills them in for all openings at once.
+    """
     try:
         entries = list(reader.find_all(board))
     except Exception:
-        reader.close()
         return None
 
     if len(entries) < 2:
-        reader.close()
         return None
 
     entries.sort(key=lambda e: e.weight, reverse=True)
@@ -255,64 +370,59 @@ def generate_opponent_responses_with_llm(opening_info, board, book_path):
             "planAdjustment": "Adapt your plan accordingly."
         })
 
-    reader.close()
-
-    if anthropic is not None and responses:
-        responses = enrich_responses_with_llm(opening_info, responses)
-
     return {
         "afterMoves": opening_info["start_moves"],
         "responses": responses
     }
 
 
-def enrich_responses_with_llm(opening_info, responses):
-    """Use LLM to add names and descriptions to opponent responses."""
+def enrich_responses_with_llm(openings):
+    """Use one LLM call to add names and descriptions to the opponent responses
+    of every opening JSON in openings, updating them in place."""
     client = anthropic.Anthropic()
 
-    moves_str = ", ".join(r["move"]["san"] for r in responses)
-    prompt = f"""In the {opening_info['name']} opening, after the standard moves, the opponent's main responses are: {moves_str}
-
-For each response, provide:
-1. The standard opening name (e.g., "Giuoco Piano", "Two Knights Defense")
-2. The ECO code
-3. A beginner-friendly description (1 sentence)
-4. How the player should adjust their plan (1 sentence)
-
-Return ONLY a JSON array:
-[{{"san": "Bc5", "name": "Opening Name", "eco": "C54", "description": "...", "planAdjustment": "..."}}]"""
+    lines = []
+    for opening_json in openings:
+        moves_str = ", ".join(r["move"]["san"] for r in opening_json["opponentResponses"]["responses"])
+        lines.append(f"- {opening_json['name']} (id: {opening_json['id']}): {moves_str}")
+    prompt = "The opponent's main responses after the standard moves of each opening:\n" + "\n".join(lines)
 
     try:
         response = client.messages.create(
             model="claude-sonnet-4-20250514",
-            max_tokens=1000,
+            max_tokens=1000 * len(openings),
+            system=SYSTEM_PROMPT_ENRICH,
             messages=[{"role": "user", "content": prompt}]
         )
         text = response.content[0].text.strip()
-        start = text.find("[")
-        end = text.rfind("]") + 1
+        start = text.find("{")
+        end = text.rfind("}") + 1
         if start >= 0 and end > start:
-            enriched = json.loads(text[start:end])
-            for enrichment in enriched:
-                for resp in responses:
-                    if resp["move"]["san"] == enrichment.get("san"):
-                        resp["name"] = enrichment.get("name", resp["name"])
-                        resp["eco"] = enrichment.get("eco", "")
-                        resp["description"] = enrichment.get("description", resp["description"])
-                        resp["planAdjustment"] = enrichment.get("planAdjustment", resp["planAdjustment"])
+            enriched = decode_json(text[start:end])
+            for opening_json in openings:
+                responses = opening_json["opponentResponses"]["responses"]
+                for enrichment in enriched.get(opening_json["id"]) or []:
+                    for resp in responses:
+                        if resp["move"]["san"] == enrichment.get("san"):
+                            resp["name"] = enrichment.get("name", resp["name"])
+                            resp["eco"] = enrichment.get("eco", "")
+                            resp["description"] = enrichment.get("description", resp["description"])
+                            resp["planAdjustment"] = enrichment.get("planAdjustment", resp["planAdjustment"])
     except Exception as e:
-        print(f"  LLM response enrichment failed: {e}")
+        print(f"LLM response enrichment failed: {e}")
 
-    return responses
 
+def generate_opening_json(opening_info, reader, stockfish_path=None):
+    """Generate a complete opening JSON document.
 
-def generate_opening_json(opening_info, book_path, output_dir, stockfish_path=None):
-    """Generate a complete opening JSON file."""
+    Opponent responses are left unenriched; main() writes the file right
+    away, then enriches all openings in one call and rewrites them.
+    """
     print(f"\nGenerating: {opening_info['name']} ({opening_info['id']})")
 
     # 1. Build tree from polyglot
     print("  Building tree from polyglot book...")
-    tree = build_tree_from_polyglot(book_path, opening_info["start_moves"])
+    tree = build_tree_from_polyglot(reader, opening_info["start_moves"])
 
     # 2. Generate plan
     print("  Generating plan...")
@@ -323,7 +433,7 @@ def generate_opening_json(opening_info, book_path, output_dir, stockfish_path=No
     board = chess.Board()
     for uci in opening_info["start_moves"]:
         board.push(uci_to_move(board, uci))
-    opponent_responses = generate_opponent_responses_with_llm(opening_info, board, book_path)
+    opponent_responses = generate_opponent_responses_with_llm(opening_info, board, reader)
 
     # 4. Assemble JSON
     opening_json = {
@@ -339,13 +449,7 @@ def generate_opening_json(opening_info, book_path, output_dir, stockfish_path=No
     if opponent_responses:
         opening_json["opponentResponses"] = opponent_responses
 
-    # 5. Write output
-    output_path = Path(output_dir) / f"{opening_info['id']}.json"
-    with open(output_path, "w") as f:
-        json.dump(opening_json, f, indent=2)
-
-    print(f"  Written to: {output_path}")
-    return output_path
+    return opening_json
 
 
 def main():
@@ -357,6 +461,7 @@ def main():
     parser.add_argument("--output", required=True, help="Output directory")
     parser.add_argument("--stockfish", help="Path to stockfish binary (for validation)")
     parser.add_argument("--skip-existing", action="store_true", help="Skip if JSON already exists")
+    parser.add_argument("--workers", type=int, default=4, help="Number of openings to generate in parallel")
     args = parser.parse_args()
 
     os.makedirs(args.output, exist_ok=True)
@@ -386,17 +491,57 @@ def main():
         print("Error: Specify --opening, --eco, or --all")
         sys.exit(1)
 
+    # One directory listing instead of a stat per opening
+    existing_files = set()
+    if args.skip_existing:
+        existing_files = {entry.name for entry in os.scandir(args.output) if entry.is_file()}
+
+    pending = []
     for opening in openings_to_generate:
-        output_path = Path(args.output) / f"{opening['id']}.json"
-        if args.skip_existing and output_path.exists():
+        if f"{opening['id']}.json" in existing_files:
             print(f"Skipping {opening['name']} (already exists)")
             continue
+        pending.append(opening)
 
+    def write_opening(opening_json):
+        output_path = Path(args.output) / f"{opening_json['id']}.json"
         try:
-            generate_opening_json(opening, args.book, args.output, args.stockfish)
+            write_json(output_path, opening_json, pretty=True)
         except Exception as e:
-            print(f"Error generating {opening['name']}: {e}")
-            continue
+            print(f"Error writing {output_path}: {e}")
+            return
+        print(f"  Written to: {output_path}")
+
+    # Openings are independent and mostly wait on book reads and Claude
+    # calls, so generate them on worker threads. They share one memory-mapped
+    # book reader, whose lookups keep no per-call state. Each opening is
+    # written as soon as it is built, so a later failure or Ctrl-C keeps it.
+    generated = []
+    with chess.polyglot.open_reader(args.book) as reader, \
+            ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {
+            executor.submit(generate_opening_json, opening, reader, args.stockfish): opening
+            for opening in pending
+        }
+        for future in as_completed(futures):
+            opening = futures[future]
+            try:
+                opening_json = future.result()
+            except Exception as e:
+                print(f"Error generating {opening['name']}: {e}")
+                continue
+            generated.append(opening_json)
+            write_opening(opening_json)
+
+    # Describe every opening's opponent responses in a single Claude call,
+    # sharing the instructions instead of repeating them per opening, then
+    # rewrite the enriched openings
+    to_enrich = [o for o in generated if "opponentResponses" in o]
+    if anthropic is not None and to_enrich:
+        print(f"\nEnriching opponent responses for {len(to_enrich)} openings...")
+        enrich_responses_with_llm(to_enrich)
+        for opening_json in to_enrich:
+            write_opening(opening_json)
 
     print("\nDone!")
 
@@ -0,0 +1,62 @@
+"""Helpers shared by the opening generation and validation scripts.
+
+JSON goes through orjson when it is installed and the stdlib json module
+otherwise; both produce the same output.
+"""
+
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+
+try:
+    import chess
+except ImportError:
+    chess = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Output files are written in one call, so a large buffer avoids splitting it
+WRITE_BUFFER_SIZE = 64 * 1024
+
+
+def decode_json(text: str | bytes):
+    """Parse JSON text, using orjson when available (its errors subclass json.JSONDecodeError)."""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def encode_json(data, pretty: bool = False) -> bytes:
+    """Serialize data as compact JSON (2-space indented if pretty), using orjson when available."""
+    if orjson is not None:
+        option = orjson.OPT_APPEND_NEWLINE
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(data, option=option)
+    if pretty:
+        text = json.dumps(data, indent=2, ensure_ascii=False)
+    else:
+        text = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    return (text + "\n").encode("utf-8")
+
+
+def write_json(path: str | Path, data, pretty: bool = False):
+    """Atomically write a JSON file: fsync a temporary sibling, then rename it over path."""
+    path = Path(path)
+    payload = encode_json(data, pretty)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+@lru_cache(maxsize=4096)
+def parse_uci(uci_str: str) -> "chess.Move":
+    """Parse a UCI move string, sharing one Move per string (Moves are never mutated)."""
+    return chess.Move.from_uci(uci_str)
@@ -1,81 +1,153 @@
 #!/usr/bin/env python3
 """Validate opening JSON trees against the Lichess chess-openings dataset."""
 
-import json
-import csv
+import argparse
 import os
+import pickle
+import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import NamedTuple
+
+from script_utils import decode_json
 
 ROOT = Path(__file__).resolve().parent.parent
 OPENINGS_DIR = ROOT / "ChessCoach" / "Resources" / "Openings"
 REFERENCE_DIR = ROOT / "ChessCoach" / "Resources" / "OpeningData"
+# Parsed reference data, kept outside the app's resources so it is never bundled
+CACHE_PATH = Path(__file__).resolve().parent / ".cache" / "lichess_openings.pkl"
+# Bump when the parsed layout changes so older caches are rebuilt
+CACHE_VERSION = 3
+# Move-number tokens joined together, e.g. "1.2.3."
+_MOVE_NUMBERS = re.compile(r"(?:\d+\.)*")
+
+
+class Entry(NamedTuple):
+    """A Lichess reference line. short_name is the name without its family
+    prefix ("Najdorf Variation" for "Sicilian Defense: Najdorf Variation"),
+    or the whole name when it has none."""
+    eco: str
+    name: str
+    short_name: str
+
+
+def parse_lichess_tsvs(tsv_files):
+    """Parse Lichess TSV files into a dict keyed by SAN move tuple.
+
+    Move numbers are dropped from the PGN, so lookups hash a short tuple of
+    moves rather than a formatted string. SAN moves and ECO codes repeat
+    across thousands of lines and are interned, so each distinct string is
+    stored once (pickle keeps that sharing in the cache).
+    """
+    openings = {}  # (san, ...) -> Entry
+    for tsv_file in tsv_files:
+        # Plain tab-separated fields with no quoting: read each file in one
+        # go and split lines directly
+        lines = Path(tsv_file).read_text(encoding="utf-8").splitlines()
+        for line in lines[1:]:  # skip header
+            row = line.split("\t", 3)
+            if len(row) >= 3:
+                eco, name, pgn = row[0], row[1], row[2]
+                tokens = pgn.split()
+                # "1. e4 e5 2. Nf3" has a move number every third token;
+                # drop them with one slice when the PGN is laid out that way
+                if _MOVE_NUMBERS.fullmatch("".join(tokens[::3])):
+                    del tokens[::3]
+                else:
+                    tokens = [tok for tok in tokens if not tok.endswith(".")]
+                short_name = name.split(": ", 1)[1] if ": " in name else name
+                openings[tuple(map(sys.intern, tokens))] = Entry(sys.intern(eco), name, short_name)
+    return openings
 
 
 def load_lichess_openings():
-    """Load all Lichess openings into a dict keyed by PGN move sequence."""
-    openings = {}  # pgn_moves -> (eco, name)
-    for tsv_file in sorted(REFERENCE_DIR.glob("*.tsv")):
-        with open(tsv_file, "r") as f:
-            reader = csv.reader(f, delimiter="\t")
-            header = next(reader)  # skip header
-            for row in reader:
-                if len(row) >= 3:
-                    eco, name, pgn = row[0], row[1], row[2]
-                    openings[pgn.strip()] = (eco, name)
+    """Load all Lichess openings into a dict keyed by SAN move tuple.
+
+    The result is cached in CACHE_PATH and reused while the TSV files' names,
+    sizes and mtimes match.
+    """
+    tsv_files = sorted(REFERENCE_DIR.glob("*.tsv"))
+    signature = (CACHE_VERSION, str(REFERENCE_DIR)) + tuple(
+        (p.name, st.st_mtime_ns, st.st_size) for p in tsv_files for st in [p.stat()])
+
+    try:
+        with open(CACHE_PATH, "rb") as f:
+            cached_signature, openings = pickle.load(f)
+        if cached_signature == signature:
+            return openings
+    except Exception:
+        pass  # missing, stale format or unreadable: rebuild below
+
+    openings = parse_lichess_tsvs(tsv_files)
+
+    try:
+        CACHE_PATH.parent.mkdir(exist_ok=True)
+        tmp_path = CACHE_PATH.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump((signature, openings), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, CACHE_PATH)
+    except OSError as e:
+        print(f"Warning: could not write {CACHE_PATH}: {e}")
     return openings
 
 
-def san_to_pgn(san_moves):
-    """Convert a list of SAN moves to PGN string."""
-    parts = []
-    for i, san in enumerate(san_moves):
-        if i % 2 == 0:
-            parts.append(f"{i // 2 + 1}. {san}")
-        else:
-            parts.append(san)
-    return " ".join(parts)
-
-
-def walk_tree(node, moves_so_far=None):
-    """Walk a JSON opening tree, yielding (path_of_san_moves, node_info) for each node."""
-    if moves_so_far is None:
-        moves_so_far = []
-
-    current_moves = list(moves_so_far)
-    if node.get("move"):
-        current_moves.append(node["move"]["san"])
+def walk_tree(root, lichess_openings):
+    """Walk a JSON opening tree, yielding (tuple_of_san_moves, pgn, match, match_pgn, node_info)
+    for each node.
+
+    Nodes come in pre-order, from an explicit stack rather than nested
+    generators. Children share their parent's move tuple, and each node's
+    PGN is its parent's with one move appended ("1. e4 e5 2. Nf3").
+
+    match is the longest prefix of the moves found in lichess_openings, or
+    None, and match_pgn its PGN. A node's longest prefix is either its own
+    moves or its parent's match, so it costs one lookup per node instead of
+    one per prefix length.
+
+    This loop runs once per node of every tree, so it keeps per-node work to
+    plain local operations: one dict read per key, no generator expressions.
+    """
+    stack = [(root, (), "", None, None)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        node, moves, pgn, match, match_pgn = pop()
+        move = node.get("move")
+        if move:
+            san = move["san"]
+            ply = len(moves)
+            token = f"{ply // 2 + 1}. {san}" if ply % 2 == 0 else san
+            pgn = f"{pgn} {token}" if pgn else token
+            moves = moves + (san,)
+            if moves in lichess_openings:
+                match = moves
+                match_pgn = pgn
+
+        yield moves, pgn, match, match_pgn, node
+
+        children = node.get("children")
+        if children:
+            # Reversed, so children pop in document order
+            for child in reversed(children):
+                push((child, moves, pgn, match, match_pgn))
 
-    yield current_moves, node
 
-    for child in node.get("children", []):
-        yield from walk_tree(child, current_moves)
-
-
-def find_best_match(pgn, lichess_openings):
-    """Find the longest matching prefix in the Lichess dataset."""
-    # Try exact match first
-    if pgn in lichess_openings:
-        return pgn, lichess_openings[pgn]
-
-    # Try progressively shorter prefixes
-    parts = pgn.split()
-    for end in range(len(parts), 0, -1):
-        candidate = " ".join(parts[:end])
-        if candidate in lichess_openings:
-            return candidate, lichess_openings[candidate]
-
-    return None, None
+def validate_opening(json_path, lichess_openings):
+    """Validate a single opening JSON file.
 
+    Returns (lines_found, lines_matched, report), where report is the text to
+    print, built as one string so files can be validated in worker processes
+    and written out with a single call.
+    """
+    data = decode_json(Path(json_path).read_bytes())
 
-def validate_opening(json_path, lichess_openings):
-    """Validate a single opening JSON file."""
-    with open(json_path) as f:
-        data = json.load(f)
+    report = []
+    out = report.append
 
-    print(f"\n{'='*70}")
-    print(f"Opening: {data['name']} ({json_path.name})")
-    print(f"{'='*70}")
+    out(f"\n{'='*70}\n")
+    out(f"Opening: {data['name']} ({json_path.name})\n")
+    out(f"{'='*70}\n")
 
     tree = data["tree"]
     lines_found = 0
@@ -83,87 +155,102 @@ def validate_opening(json_path, lichess_openings):
     issues = []
     name_suggestions = {}
 
-    # Collect all leaf paths (complete lines)
+    # Collect all leaf paths (complete lines) in one walk, checking named
+    # branch points on the way so only their mismatches are kept
     leaves = []
-    for moves, node in walk_tree(tree):
+    name_mismatches = []
+    for moves, pgn, match_moves, match_pgn, node in walk_tree(tree, lichess_openings):
         if not node.get("children"):
-            leaves.append((moves, node))
+            leaves.append((moves, pgn, match_moves, match_pgn, node))
+        elif moves and node.get("variationName"):
+            entry = lichess_openings.get(match_moves)
+            ours = node["variationName"]
+            if entry and ours != entry.short_name and ours != entry.name:
+                name_mismatches.append((pgn, ours, entry))
 
-    print(f"\nTotal lines (leaf nodes): {len(leaves)}")
-    print()
+    out(f"\nTotal lines (leaf nodes): {len(leaves)}\n")
+    out("\n")
 
     # Check each leaf line
-    for moves, node in leaves:
+    for moves, pgn, match_moves, match_pgn, node in leaves:
         lines_found += 1
-        pgn = san_to_pgn(moves)
         variation_name = node.get("variationName", "")
 
-        # Find exact or longest prefix match
-        match_pgn, match_info = find_best_match(pgn, lichess_openings)
+        # Exact or longest prefix match, found during the walk
+        entry = lichess_openings.get(match_moves)
 
-        if match_pgn == pgn:
+        if match_moves == moves:
             lines_matched += 1
-            eco, canonical_name = match_info
             status = "EXACT"
-        elif match_pgn:
-            eco, canonical_name = match_info
-            matched_moves = len(match_pgn.split())
-            total_parts = len(pgn.split())
-            # Count actual moves (not move numbers)
+        elif match_moves:
+            matched_moves = len(match_moves)
+            total_parts = len(moves)
             status = f"PARTIAL (matched {match_pgn})"
             lines_matched += 1
         else:
             status = "NO MATCH"
-            canonical_name = None
-            eco = None
 
         # Print line info
-        node_id = node.get("id", "?")
-        inherited_name = variation_name or node_id.split("/")[-1]
-        print(f"  Line: {pgn}")
-        if canonical_name:
-            print(f"    Lichess: [{eco}] {canonical_name}")
+        out(f"  Line: {pgn}\n")
+        if entry:
+            out(f"    Lichess: [{entry.eco}] {entry.name}\n")
             if variation_name:
-                print(f"    Our name: {variation_name}")
+                out(f"    Our name: {variation_name}\n")
             # Store name suggestion for the best matching position
-            name_suggestions[node.get("id")] = (eco, canonical_name)
+            name_suggestions[node.get("id")] = entry
         else:
-            print(f"    WARNING: No match in Lichess dataset")
-        print(f"    Status: {status}")
-        print()
+            out(f"    WARNING: No match in Lichess dataset\n")
+        out(f"    Status: {status}\n")
+        out("\n")
 
     # Also check intermediate positions (branch points)
-    print(f"\n--- Branch point names ---")
-    for moves, node in walk_tree(tree):
-        if not moves:
-            continue
-        if node.get("children") and node.get("variationName"):
-            pgn = san_to_pgn(moves)
-            match_pgn, match_info = find_best_match(pgn, lichess_openings)
-            if match_info:
-                eco, canonical = match_info
-                ours = node["variationName"]
-                if ours != canonical.split(": ", 1)[-1] if ": " in canonical else canonical:
-                    print(f"  Position: {pgn}")
-                    print(f"    Our name: {ours}")
-                    print(f"    Lichess:  [{eco}] {canonical}")
-                    print()
-
-    print(f"\nSummary: {lines_matched}/{lines_found} lines found in Lichess dataset")
-    return lines_found, lines_matched
+    out(f"\n--- Branch point names ---\n")
+    for pgn, ours, entry in name_mismatches:
+        out(f"  Position: {pgn}\n")
+        out(f"    Our name: {ours}\n")
+        out(f"    Lichess:  [{entry.eco}] {entry.name}\n")
+        out("\n")
+
+    out(f"\nSummary: {lines_matched}/{lines_found} lines found in Lichess dataset\n")
+    return lines_found, lines_matched, "".join(report)
+
+
+# Reference data for worker processes, set once per worker by _init_worker()
+_lichess = None
+
+
+def _init_worker(lichess_openings):
+    global _lichess
+    _lichess = lichess_openings
+
+
+def _validate_file(json_path):
+    return validate_opening(json_path, _lichess)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Validate opening JSON trees against the Lichess dataset")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of files to validate in parallel")
+    args = parser.parse_args()
+
     lichess = load_lichess_openings()
     print(f"Loaded {len(lichess)} openings from Lichess dataset")
 
     total_lines = 0
     total_matched = 0
 
-    for json_file in sorted(OPENINGS_DIR.glob("*.json")):
-        found, matched = validate_opening(json_file, lichess)
-        total_lines += found
-        total_matched += matched
+    # Files are independent and CPU-bound, so validate them in worker
+    # processes that each receive the reference data once. Reports are
+    # printed in file order, as they would be from a serial run.
+    json_files = sorted(OPENINGS_DIR.glob("*.json"))
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(json_files) or 1)),
+                             initializer=_init_worker,
+                             initargs=(lichess,)) as executor:
+        for found, matched, report in executor.map(_validate_file, json_files):
+            sys.stdout.write(report)
+            total_lines += found
+            total_matched += matched
 
     print(f"\n{'='*70}")
     print(f"OVERALL: {total_matched}/{total_lines} lines matched against Lichess data")